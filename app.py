@@ -1,16 +1,26 @@
 import logging
 import os
 import redis
+import signal
+import sys
 import yaml
 
 from flask import Flask
 
+from image_finder import migrate_cuisine_images
+from janitor import Janitor
+from parties import migrate_parties
+from sessions import migrate_sessions
+from storage import MemoryStore
+from sweeper import PartySweeper
+
 from location_search import find_similar_locations_blueprint
+from metrics import metrics_blueprint
 from party_names import generate_party_name_blueprint
 
 from send_www_logic import send_images_to_www_blueprint
 from send_www_logic import send_solo_winner_to_www_blueprint
-from twilio_flow import receive_text_blueprint
+from twilio_flow import finalize_party, receive_text_blueprint
 
 logging.basicConfig(level=logging.INFO)
 app = Flask(__name__)
@@ -33,6 +43,9 @@ app.register_blueprint(send_images_to_www_blueprint)
 # Register the blueprint for the /solo_winner endpoint
 app.register_blueprint(send_solo_winner_to_www_blueprint)
 
+# Register the blueprint for the /metrics endpoint
+app.register_blueprint(metrics_blueprint)
+
 
 if __name__ == "__main__":
     try:
@@ -47,31 +60,35 @@ if __name__ == "__main__":
         APP_PORT = int(os.getenv("PORT", config["app_port"]))
 
         # TODO:
-        # Allow the party creator to set a quorum size,
-        # as well as a set a limit on the number of votes
-        # that a single indvidual can make
+        # Allow the party creator to set a limit on the number
+        # of votes that a single indvidual can make
         SOLO_QUORUM = config["quorum"]["solo"]
         PARTY_QUORUM = config["quorum"]["party"]
 
         REDIS_HOST = os.environ.get("REDIS_HOST_URL")
         REDIS_PORT = os.environ.get("REDIS_HOST_PORT")
-        try:
-            redis_instance = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
-            redis_instance.ping()
-        except Exception as exception:
-            print(exception)
-            print("Could not connect to redis instance at: {}:{}".format(REDIS_HOST, REDIS_PORT))
+        redis_instance = None
+        if config["storage"]["backend"] == "redis":
             try:
-                print("Trying to connect to 127.0.0.1 at port 6379")
-                redis_instance = redis.Redis(host="127.0.0.1", port=6379)
+                redis_instance = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
                 redis_instance.ping()
-                print("Able to connect to Redis instance at 127.0.0.1:6379")
             except Exception as exception:
                 print(exception)
-                print("Couldn't connect to local Redis instance either. Redis functionality will be disabled.")
-                redis_instance = None
-        finally:
-            app.config["redis"] = redis_instance
+                print("Could not connect to redis instance at: {}:{}".format(REDIS_HOST, REDIS_PORT))
+                try:
+                    print("Trying to connect to 127.0.0.1 at port 6379")
+                    redis_instance = redis.Redis(host="127.0.0.1", port=6379)
+                    redis_instance.ping()
+                    print("Able to connect to Redis instance at 127.0.0.1:6379")
+                except Exception as exception:
+                    print(exception)
+                    print("Couldn't connect to local Redis instance either. State will be kept in memory.")
+                    redis_instance = None
+        if redis_instance is None:
+            # Keep state within this process, which suits a single process.
+            redis_instance = MemoryStore(
+                max_keys=config["storage"]["memory_max_keys"])
+        app.config["redis"] = redis_instance
 
         if redis_instance:
             # These are some text files that contain the strings
@@ -83,4 +100,26 @@ if __name__ == "__main__":
                 food_names = food_names.readlines()
                 redis_instance.sadd("foodnames", *food_names)
 
+            # Move cuisine images, sessions and parties out of the hashes
+            # in which they were kept.
+            migrate_cuisine_images(redis_instance)
+            migrate_sessions(redis_instance)
+            migrate_parties(redis_instance)
+
+            # End parties that are past their deadlines in the background.
+            party_sweeper = PartySweeper(
+                redis_instance, finalize_party,
+                interval=config["parties"]["sweep_interval"])
+            # Reclaim what was left behind in redis in the background.
+            janitor = Janitor(redis_instance,
+                              interval=config["janitor"]["interval"],
+                              batch_size=config["janitor"]["batch_size"],
+                              image_cap=config["janitor"]["image_cap"],
+                              image_max_idle=config["janitor"][
+                                  "image_max_idle"])
+
+        # Exit cleanly on SIGTERM, so that queued outbound messages
+        # are delivered before the process goes away.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
         app.run(host=APP_HOST, port=APP_PORT)
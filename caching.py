@@ -0,0 +1,163 @@
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+
+# The field of a node of a PrefixIndex that holds the strings most recently
+# added beneath it. None can't be a character of a string.
+_RECENT = None
+
+
+class TTLCache(object):
+    """
+    A thread-safe, in-process cache holding at most some number of entries,
+    each of which expires some number of seconds after being set. When the
+    cache is full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        Args:
+            max_size:   The maximum number of entries to hold.
+            ttl:        The number of seconds after which an entry expires.
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._counts = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for the key, or default if there is none.
+
+        Args:
+            key:        The key of the entry.
+            default:    The value returned when there is no such entry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self._entries.pop(key, None)
+                self._counts["misses"] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._counts["hits"] += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Caches the value for the key, evicting the least recently used
+        entry if the cache is full.
+
+        Args:
+            key:        The key of the entry.
+            value:      The value to cache.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self._ttl, value)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._counts["evictions"] += 1
+
+    def stats(self):
+        """
+        Returns the cache's size, along with its hit, miss and eviction
+        counters.
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats["size"] = len(self._entries)
+            return stats
+
+
+class PrefixIndex(object):
+    """
+    A thread-safe, in-process trie of strings, used to find the most
+    recently added strings that start with some prefix. When it holds
+    more than some number of strings, the least recently added string
+    is dropped.
+    """
+
+    def __init__(self, max_size, recent_size):
+        """
+        Args:
+            max_size:       The maximum number of strings to hold.
+            recent_size:    The maximum number of strings found for a prefix.
+        """
+        self._max_size = max_size
+        self._recent_size = recent_size
+        self._root = {_RECENT: OrderedDict()}
+        # Maps each string to its value, from the least to the most
+        # recently added string.
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+    def add(self, key, value):
+        """
+        Adds a string to the index.
+
+        Args:
+            key:    The string to add.
+            value:  The value returned when the string is found.
+        """
+        with self._lock:
+            path = [self._root]
+            for char in key:
+                path.append(path[-1].setdefault(char,
+                                                {_RECENT: OrderedDict()}))
+            # The empty string can't be a character, so it marks the end of
+            # a string.
+            path[-1][""] = True
+            # Each node keeps the strings most recently added beneath it, so
+            # that finding them doesn't walk the node's subtree.
+            for node in path:
+                node[_RECENT].pop(key, None)
+                node[_RECENT][key] = None
+                if len(node[_RECENT]) > self._recent_size:
+                    node[_RECENT].popitem(last=False)
+            self._values.pop(key, None)
+            self._values[key] = value
+            while len(self._values) > self._max_size:
+                oldest, _ = self._values.popitem(last=False)
+                self._remove(oldest)
+
+    def find(self, prefix, limit):
+        """
+        Returns the values of the most recently added strings that start
+        with the prefix.
+
+        Args:
+            prefix: The string with which the strings found start.
+            limit:  The maximum number of values to return, at most
+                    recent_size.
+        """
+        with self._lock:
+            node = self._root
+            for char in prefix:
+                node = node.get(char)
+                if node is None:
+                    return []
+            keys = list(reversed(node[_RECENT]))[:limit]
+            return [self._values[key] for key in keys]
+
+    def _remove(self, key):
+        """
+        Removes a string from the trie, along with the nodes that no longer
+        lead to any strings.
+
+        Args:
+            key:    The string to remove.
+        """
+        path = [self._root]
+        for char in key:
+            path.append(path[-1][char])
+        del path[-1][""]
+        for node in path:
+            node[_RECENT].pop(key, None)
+        for idx in range(len(key), 0, -1):
+            if len(path[idx]) > 1:
+                break
+            del path[idx - 1][key[idx - 1]]
@@ -0,0 +1,102 @@
+import logging
+import math
+import random
+import yaml
+
+
+def pick_cuisine(strategy, cuisines, scores, shown):
+    """
+    Picks the next cuisine for which to send an image.
+
+    Args:
+        strategy:   The name of the strategy to pick the cuisine with,
+                    one of "random", "ucb" or "thompson".
+        cuisines:   A list of strings of the cuisines to choose from.
+        scores:     A dictionary mapping cuisines to their scores.
+        shown:      A dictionary mapping cuisines to the number of times
+                    that an image of each has been sent.
+
+    Returns:
+        A string representing the next cuisine.
+    """
+    return STRATEGIES[strategy](cuisines, scores, shown)
+
+
+def is_adaptive(strategy):
+    """
+    Determines whether a strategy relies on the scores and the number of
+    times each cuisine has been shown, which then have to be kept track of.
+
+    Args:
+        strategy:   The name of a strategy.
+
+    Returns:
+        A boolean.
+    """
+    return strategy != "random"
+
+
+def pick_random(cuisines, scores, shown):
+    """
+    Picks any of the cuisines, ignoring how they've been voted on.
+    """
+    return random.choice(cuisines)
+
+
+def pick_ucb(cuisines, scores, shown):
+    """
+    Picks the cuisine with the highest upper confidence bound (UCB1) on its
+    average vote, which favours well liked cuisines, along with cuisines
+    that haven't been shown often enough to tell.
+    """
+    # Every cuisine is shown once before the bounds can be computed.
+    unseen = [cuisine for cuisine in cuisines if not shown.get(cuisine)]
+    if unseen:
+        return random.choice(unseen)
+    total = sum(shown[cuisine] for cuisine in cuisines)
+
+    def bound(cuisine):
+        times = float(shown[cuisine])
+        average = scores.get(cuisine, 0) / times
+        return average + UCB_EXPLORATION * math.sqrt(2 * math.log(total)
+                                                     / times)
+
+    return max(random.sample(cuisines, len(cuisines)), key=bound)
+
+
+def pick_thompson(cuisines, scores, shown):
+    """
+    Picks a cuisine with the probability that it's the best liked one, by
+    drawing a likelihood of being liked for each cuisine from a beta
+    distribution over its votes, and picking the cuisine with the highest.
+    """
+    def draw(cuisine):
+        times = shown.get(cuisine, 0)
+        score = scores.get(cuisine, 0)
+        # A score is the number of likes less the number of dislikes.
+        # Votes that were neither count as half of each.
+        likes = max(0, (times + score) / 2.0)
+        dislikes = max(0, (times - score) / 2.0)
+        return random.betavariate(1 + likes, 1 + dislikes)
+
+    return max(cuisines, key=draw)
+
+
+STRATEGIES = {"random": pick_random,
+              "ucb": pick_ucb,
+              "thompson": pick_thompson}
+
+
+try:
+    with open("config", "r") as stream:
+        config = yaml.safe_load(stream)
+
+except Exception as error:
+    logging.error("Something wrong with the config file, " + str(error))
+
+else:
+    # How strongly UCB favours cuisines that have been shown less often.
+    UCB_EXPLORATION = config["selection"]["ucb_exploration"]
+    # The strategies used to pick cuisines for solo users and for parties.
+    SOLO_SELECTION = config["selection"]["solo"]
+    PARTY_SELECTION = config["selection"]["party"]
@@ -0,0 +1,115 @@
+import json
+import logging
+import time
+import yaml
+
+from flask import current_app, make_response, request
+from functools import wraps
+from redis.exceptions import LockError
+
+from storage import decode
+
+
+# Stored for a message while it's being handled.
+_PENDING = "pending"
+
+
+def handles_once(view):
+    """
+    Decorates a webhook view so that each inbound message is handled only
+    once, even though Twilio may deliver it several times. The response
+    to a message is kept for a while, keyed by the message's MessageSid,
+    and is sent again, without handling the message again, in answer to
+    any redelivery. Messages from the same user are also handled one at a
+    time, so that they can't race each other on the user's session.
+
+    Args:
+        view:   The Flask view function handling an inbound message.
+
+    Returns:
+        The decorated view function.
+    """
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        redis = current_app.config["redis"]
+        message_sid = request.form.get("MessageSid")
+        if not redis or not message_sid:
+            return view(*args, **kwargs)
+        key = HANDLED_PREFIX + message_sid
+        if not redis.set(key, _PENDING, nx=True, ex=DEDUPE_TTL):
+            logging.info(u"Replaying the response to " + message_sid)
+            return _replay(redis, key)
+
+        sender_lock = redis.lock(SENDER_LOCK_PREFIX + request.form["From"],
+                                 timeout=LOCK_TIMEOUT)
+        locked = sender_lock.acquire(blocking_timeout=LOCK_WAIT)
+        if not locked:
+            logging.warning(u"Handling {0} without the sender's lock".format(
+                            message_sid))
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            # Let a redelivery of the message try again.
+            redis.delete(key)
+            raise
+        finally:
+            if locked:
+                try:
+                    sender_lock.release()
+                except LockError:
+                    # The lock expired while the message was handled.
+                    pass
+        redis.set(key, json.dumps({"body": response.get_data(as_text=True),
+                                   "status": response.status_code,
+                                   "content_type": response.content_type}),
+                  ex=DEDUPE_TTL)
+        return response
+    return decorated_view
+
+
+def _replay(redis, key):
+    """
+    Builds the response to a message that was delivered again, waiting
+    for the response if the message is still being handled.
+
+    Args:
+        redis:  The redis instance.
+        key:    The key under which the response is kept.
+
+    Returns:
+        The response.
+    """
+    deadline = time.time() + REPLAY_WAIT
+    handled = decode(redis.get(key))
+    while handled == _PENDING and time.time() < deadline:
+        time.sleep(0.1)
+        handled = decode(redis.get(key))
+    # Give up on a response that's still pending, and answer with nothing.
+    if handled is None or handled == _PENDING:
+        return "", 200
+    handled = json.loads(handled)
+    return handled["body"], handled["status"], {"Content-Type":
+                                                handled["content_type"]}
+
+
+try:
+    with open("config", "r") as stream:
+        config = yaml.safe_load(stream)
+
+except Exception as error:
+    logging.error("Something wrong with the config file, " + str(error))
+
+else:
+    # The response to each handled message is kept under this prefix,
+    # suffixed with the message's MessageSid.
+    HANDLED_PREFIX = "sms:handled:"
+    # Seconds for which the response to a handled message is kept.
+    DEDUPE_TTL = config["webhook"]["dedupe_ttl"]
+    # Seconds that a redelivered message waits for the original's response.
+    REPLAY_WAIT = config["webhook"]["replay_wait"]
+    # Held, suffixed with the user's number, while a message is handled.
+    SENDER_LOCK_PREFIX = "sms:lock:"
+    # Seconds after which a user's lock expires, and that a message
+    # waits for the lock.
+    LOCK_TIMEOUT = config["webhook"]["lock_timeout"]
+    LOCK_WAIT = config["webhook"]["lock_wait"]
@@ -3,15 +3,50 @@ import logging
 import os
 import random
 import requests
+import time
+import uuid
 import yaml
 
-from threading import Thread
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
+
+from storage import decode, script_fallback
+
+
+# Cuisines whose images are being fetched by this process.
+_fetches_in_flight = set()
+_fetches_lock = Lock()
+_fetch_counts = {"queued": 0, "running": 0, "completed": 0,
+                 "deduplicated": 0}
+
+# Releases a cuisine's fetch lock only if it is still held with the token
+# that took it, so that a fetch that outlived FETCH_LOCK_TIMEOUT can't
+# release the lock taken by the next fetch.
+#   KEYS: cuisines:fetching:<cuisine>
+#   ARGV: the lock's token
+_RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+@script_fallback(_RELEASE_SCRIPT)
+def _release(store, keys, args):
+    """
+    Runs _RELEASE_SCRIPT on a store that can't run Lua.
+    """
+    if decode(store.get(keys[0])) == args[0]:
+        return store.delete(keys[0])
+    return 0
 
 
 def add_cuisine_images_to_redis(cuisines, redis):
     """
-    Spin a new thread that finds images for each cuisine for which
-    we don't have images.
+    Queues a fetch of images for each cuisine for which we don't have
+    images, unless a fetch for that cuisine is already underway, or
+    recently found no images.
 
     Args:
         cuisines:   A list strings of cuisines.
@@ -21,11 +56,124 @@ def add_cuisine_images_to_redis(cuisines, redis):
         print("No Redis instance. Not adding images to Redis")
         return
     for cuisine in cuisines:
-        if not redis.hexists("cuisines", cuisine):
-            thread = Thread(target=_add_cuisine_images_to_redis,
-                            args=(cuisine, redis))
-            thread.daemon = True
-            thread.start()
+        if (not has_cuisine_images(cuisine, redis)
+                and not _is_missing_images(cuisine, redis)):
+            _queue_fetch(cuisine, redis)
+
+
+def has_cuisine_images(cuisine, redis):
+    """
+    Determines whether redis holds images for the cuisine.
+
+    Args:
+        cuisine:    A string representing a cuisine.
+        redis:      A reference to the redis server.
+
+    Returns:
+        A boolean, indicating whether there are images for the cuisine.
+    """
+    return bool(redis.exists(CUISINE_IMAGES_PREFIX + cuisine))
+
+
+def _is_missing_images(cuisine, redis):
+    """
+    Determines whether a recent fetch of images for the cuisine found none.
+
+    Args:
+        cuisine:    A string representing a cuisine.
+        redis:      A reference to the redis server.
+
+    Returns:
+        A boolean, indicating whether the cuisine is known to have no images
+        for now.
+    """
+    return bool(redis.exists(MISSING_IMAGES_PREFIX + cuisine))
+
+
+def migrate_cuisine_images(redis):
+    """
+    Moves images stored as JSON in the "cuisines" hash, where they were
+    kept before, to the set of images of each cuisine.
+
+    Args:
+        redis:      A reference to the redis server.
+    """
+    for cuisine, images in redis.hscan_iter("cuisines"):
+        images = json.loads(images)
+        pipeline = redis.pipeline(transaction=False)
+        if images:
+            pipeline.sadd(CUISINE_IMAGES_PREFIX + decode(cuisine), *images)
+        pipeline.hdel("cuisines", cuisine)
+        pipeline.execute()
+
+
+def _queue_fetch(cuisine, redis):
+    """
+    Queues a fetch of images for the cuisine on the fetch executor.
+    A cuisine is only ever fetched by one worker at a time, across
+    every process sharing the redis server.
+
+    Args:
+        cuisine:    A string representing a cuisine.
+        redis:      A reference to the redis server.
+    """
+    with _fetches_lock:
+        if cuisine in _fetches_in_flight:
+            _fetch_counts["deduplicated"] += 1
+            return
+        _fetches_in_flight.add(cuisine)
+    # Other processes may already be fetching this cuisine.
+    token = uuid.uuid4().hex
+    if not redis.set(FETCH_LOCK_PREFIX + cuisine, token,
+                     nx=True, px=FETCH_LOCK_TIMEOUT * 1000):
+        with _fetches_lock:
+            _fetches_in_flight.discard(cuisine)
+            _fetch_counts["deduplicated"] += 1
+        return
+    with _fetches_lock:
+        _fetch_counts["queued"] += 1
+    _fetch_executor.submit(_fetch_cuisine_images, cuisine, token, redis)
+
+
+def _fetch_cuisine_images(cuisine, token, redis):
+    """
+    Runs a queued fetch of images for the cuisine, and then releases
+    the cuisine so that it may be fetched again.
+
+    Args:
+        cuisine:    A string representing a cuisine.
+        token:      The token with which the cuisine's fetch lock was taken.
+        redis:      A reference to the redis server.
+    """
+    with _fetches_lock:
+        _fetch_counts["queued"] -= 1
+        _fetch_counts["running"] += 1
+    try:
+        # Another fetch may have finished between the check for images
+        # and the taking of the lock.
+        if (not has_cuisine_images(cuisine, redis)
+                and not _is_missing_images(cuisine, redis)):
+            _add_cuisine_images_to_redis(cuisine, redis)
+    finally:
+        release = redis.register_script(_RELEASE_SCRIPT)
+        release(keys=[FETCH_LOCK_PREFIX + cuisine], args=[token])
+        with _fetches_lock:
+            _fetches_in_flight.discard(cuisine)
+            _fetch_counts["running"] -= 1
+            _fetch_counts["completed"] += 1
+
+
+def fetch_stats():
+    """
+    Returns counters for this process's cuisine image fetches.
+
+    Returns:
+        A dictionary with the number of fetches that are queued, running
+        and completed, and the number of requested fetches that were
+        dropped since the cuisine was already being fetched.
+    """
+    with _fetches_lock:
+        return dict(_fetch_counts)
 
 
 def _add_cuisine_images_to_redis(cuisine, redis):
@@ -37,8 +185,57 @@ def _add_cuisine_images_to_redis(cuisine, redis):
         redis:      A reference to the redis server.
     """
     term = cuisine + u" food"
-    image_uris = find_images(term)
-    redis.hset("cuisines", cuisine, json.dumps(image_uris))
+    try:
+        image_uris = find_images(term)
+    except Exception as error:
+        logging.error(u"Could not find images for {0}: {1}".format(cuisine,
+                                                                   error))
+        image_uris = []
+    # Only store images that were found, so that a cuisine without images
+    # will be searched for again later. Until then, the cuisine is marked
+    # as missing images, so that requests fall back right away rather than
+    # searching, and waiting, again.
+    if image_uris:
+        pipeline = redis.pipeline(transaction=False)
+        pipeline.sadd(CUISINE_IMAGES_PREFIX + cuisine, *image_uris)
+        pipeline.zadd(IMAGES_ACCESSED, cuisine, time.time())
+        pipeline.delete(MISSING_IMAGES_PREFIX + cuisine)
+        pipeline.execute()
+    else:
+        redis.set(MISSING_IMAGES_PREFIX + cuisine, "1", ex=MISSING_IMAGES_TTL)
+    # Wake up any requests waiting on this cuisine's images, even when no
+    # images were found, so that they can fall back right away.
+    redis.publish(CUISINE_READY_CHANNEL + cuisine, "ready")
+
+
+def _wait_for_cuisine_images(cuisine, redis):
+    """
+    Waits until images for the cuisine have been added to redis,
+    or until WAIT_TIMEOUT seconds have passed.
+
+    Args:
+        cuisine:    A string representing a cuisine.
+        redis:      A reference to the redis server.
+
+    Returns:
+        A boolean, indicating whether there are images for the cuisine.
+    """
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(CUISINE_READY_CHANNEL + cuisine)
+        # The images may have been added before we subscribed.
+        found_images = has_cuisine_images(cuisine, redis)
+        deadline = time.time() + WAIT_TIMEOUT
+        while not found_images and time.time() < deadline:
+            message = pubsub.get_message(timeout=deadline - time.time())
+            if message is not None:
+                found_images = has_cuisine_images(cuisine, redis)
+                break
+    finally:
+        pubsub.close()
+    if not found_images:
+        logging.info(u"No images available for " + cuisine)
+    return found_images
 
 
 def get_random_cuisine_image_from_redis(cuisine, redis, number=1):
@@ -54,15 +251,21 @@ def get_random_cuisine_image_from_redis(cuisine, redis, number=1):
         A string representing a URI of an image if number is 1,
         otherwise returns a list of URIs.
     """
-    if not redis:
-        print("No Redis instance. Returning empty list of images")
-        return []
-    images = []
-    while not images:
-        images = redis.hget("cuisines", cuisine)
-    images = json.loads(images)
+    if redis:
+        images = _sample_cuisine_images(cuisine, redis, number)
+        if images is None and not _is_missing_images(cuisine, redis):
+            # Make sure that the images are being fetched in the
+            # background, and wait for them.
+            add_cuisine_images_to_redis([cuisine], redis)
+            if _wait_for_cuisine_images(cuisine, redis):
+                images = _sample_cuisine_images(cuisine, redis, number)
+        if images is not None:
+            return images
+    else:
+        print("No Redis instance. Returning fallback images")
+    images = FALLBACK_IMAGES
     if number == 1:
-        return random.choice(images)
+        return random.choice(images) if images else None
     # In case there aren't enough cuisine images available,
     # since the sample size cannot be larger than the size
     # of the sample space.
@@ -71,6 +274,38 @@ def get_random_cuisine_image_from_redis(cuisine, redis, number=1):
     return images
 
 
+def _sample_cuisine_images(cuisine, redis, number):
+    """
+    Samples images for the cuisine within redis, without transferring
+    the cuisine's other images.
+
+    Args:
+        cuisine:    A string representing a cuisine.
+        redis:      A reference to the redis server.
+        number:     The number of images to return
+
+    Returns:
+        A string representing a URI of an image if number is 1, otherwise
+        a list of distinct URIs. None if there are no images for the cuisine.
+    """
+    key = CUISINE_IMAGES_PREFIX + cuisine
+    pipeline = redis.pipeline(transaction=False)
+    if number == 1:
+        pipeline.srandmember(key)
+    else:
+        # A positive count never returns more images than the set holds.
+        pipeline.srandmember(key, number)
+    # Keep track of when the cuisine's images were last used, so that
+    # the least recently used images can be evicted.
+    pipeline.zadd(IMAGES_ACCESSED, cuisine, time.time())
+    images, _ = pipeline.execute()
+    if not images:
+        return None
+    if number == 1:
+        return decode(images)
+    return [decode(image) for image in images]
+
+
 def find_images(term):
     """
     Downloads and returns images for some search query.
@@ -81,18 +316,83 @@ def find_images(term):
     Returns:
         A list of strings representing image URIs.
     """
+    if PROVIDER_MODE != "sequential":
+        return _find_images_concurrently(term)
     # Try to find an image related to the term argument,
     # first using Yummly's API.
-    uris = yummly_images(term)
+    uris = _provider_images(yummly_images, term)
     if not uris:
         # If no results from Yummly, try Flickr.
-        uris = flickr_images(term)
+        uris = _provider_images(flickr_images, term)
     if not uris:
         # If still no results, try Getty.
-        uris = getty_images(term)
+        uris = _provider_images(getty_images, term)
+    return uris
+
+
+def _find_images_concurrently(term):
+    """
+    Downloads and returns images for some search query, asking the image
+    providers in parallel, or, when hedging, asking the next provider
+    whenever the previous ones haven't answered within HEDGE_DELAY.
+
+    Args:
+        term:       A string used for image search query.
+
+    Returns:
+        A list of strings representing image URIs, either those of the
+        first provider to find any, or, if MERGE_CAP is set, those of
+        several providers up to MERGE_CAP.
+    """
+    providers = [yummly_images, flickr_images, getty_images]
+    hedge_delay = HEDGE_DELAY if PROVIDER_MODE == "hedged" else 0
+    pending = set()
+    uris = []
+    while providers or pending:
+        # Ask the next provider right away, unless we're hedging
+        # and are still waiting on an earlier provider.
+        if providers and not (pending and hedge_delay):
+            pending.add(_provider_executor.submit(_provider_images,
+                                                  providers.pop(0), term))
+            continue
+        done, pending = wait(pending,
+                             timeout=hedge_delay if providers else None,
+                             return_when=FIRST_COMPLETED)
+        for future in done:
+            uris.extend(future.result())
+        if uris and (not MERGE_CAP or len(uris) >= MERGE_CAP):
+            break
+        if not done:
+            # The providers we're waiting on are slow, so hedge.
+            pending.add(_provider_executor.submit(_provider_images,
+                                                  providers.pop(0), term))
+    # Any straggling providers are left to finish, their images unused.
+    for future in pending:
+        future.cancel()
+    if MERGE_CAP:
+        uris = uris[:MERGE_CAP]
     return uris
 
 
+def _provider_images(provider, term):
+    """
+    Asks an image provider for images, treating a failure as no images.
+
+    Args:
+        provider:   A function such as yummly_images.
+        term:       A string used for image search query.
+
+    Returns:
+        A list of strings representing image URIs.
+    """
+    try:
+        return provider(term)
+    except Exception as error:
+        logging.error(u"{0} failed for {1}: {2}".format(provider.__name__,
+                                                        term, error))
+        return []
+
+
 def yummly_images(term):
     """
     Downloads and returns images for some search query.
@@ -105,7 +405,8 @@ def yummly_images(term):
     """
     image_uris = []
     request = YUMMLY_REQUEST + term
-    response = requests.get(request, headers=YUMMLY_HEADER)
+    response = requests.get(request, headers=YUMMLY_HEADER,
+                            timeout=PROVIDER_TIMEOUT)
     if response.status_code == 200:
         response = response.json()
         matches = response["matches"]
@@ -129,7 +430,7 @@ def flickr_images(term):
     """
     image_uris = []
     request = FLICKR_REQUEST + term
-    response = requests.get(request)
+    response = requests.get(request, timeout=PROVIDER_TIMEOUT)
     if response.status_code == 200:
         response = response.content
         # Clean the response up and have it ready to parse the JSON
@@ -159,7 +460,8 @@ def getty_images(term):
     """
     image_uris = []
     request = GETTY_REQUEST + term
-    response = requests.get(request, headers=GETTY_HEADER)
+    response = requests.get(request, headers=GETTY_HEADER,
+                            timeout=PROVIDER_TIMEOUT)
     if response.status_code == 200:
         response = response.json()
         images = response["images"]
@@ -205,3 +507,40 @@ else:
                               "?requirePictures=true",
                               "&maxResult=", str(YUMMLY_RESULTS),
                               "&q="])
+
+    # A set of image URIs is kept for each cuisine, suffixed with the cuisine.
+    CUISINE_IMAGES_PREFIX = "images:"
+    # A sorted set of cuisines, scored by when their images were last used.
+    IMAGES_ACCESSED = "cuisines:accessed"
+    # Requests waiting on a cuisine's images are notified on this channel,
+    # suffixed with the cuisine, once the images have been added to redis.
+    CUISINE_READY_CHANNEL = "cuisines:ready:"
+    # The number of seconds to wait for a cuisine's images to be found.
+    WAIT_TIMEOUT = config["images"]["wait_timeout"]
+    # Images used when none could be found for a cuisine.
+    FALLBACK_IMAGES = config["images"]["fallback"]
+    # A key, suffixed with the cuisine, set for MISSING_IMAGES_TTL seconds
+    # after a fetch finds no images for the cuisine.
+    MISSING_IMAGES_PREFIX = "cuisines:missing:"
+    MISSING_IMAGES_TTL = config["images"]["missing_ttl"]
+
+    # Images are fetched by a fixed number of threads.
+    _fetch_executor = ThreadPoolExecutor(
+        max_workers=config["images"]["fetch_workers"])
+    # A key, suffixed with the cuisine, held while the cuisine is fetched.
+    FETCH_LOCK_PREFIX = "cuisines:fetching:"
+    # The number of seconds after which an unreleased fetch lock expires.
+    FETCH_LOCK_TIMEOUT = config["images"]["fetch_lock_timeout"]
+
+    # How the image providers are asked for images: "sequential",
+    # "parallel" or "hedged".
+    PROVIDER_MODE = config["images"]["provider_mode"]
+    # Seconds to wait on a provider before also asking the next one.
+    HEDGE_DELAY = config["images"]["hedge_delay"]
+    # Seconds after which a request to a provider is abandoned.
+    PROVIDER_TIMEOUT = config["images"]["provider_timeout"]
+    # If set, images are merged from providers up to this many images.
+    MERGE_CAP = config["images"]["merge_cap"]
+    # Providers are asked for images by their own threads.
+    _provider_executor = ThreadPoolExecutor(
+        max_workers=config["images"]["provider_workers"])
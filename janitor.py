@@ -0,0 +1,314 @@
+import logging
+import time
+
+from threading import Event, Lock, Thread
+
+from image_finder import CUISINE_IMAGES_PREFIX, IMAGES_ACCESSED
+from parties import delete_party
+from sessions import SESSION_TTL
+from storage import PARTY_DEADLINES, SESSION_PREFIX, decode, parse_party_key
+from storage import party_key, party_keys
+
+# Counters for what this process's janitor has reclaimed.
+_janitor_lock = Lock()
+_janitor_counts = {"passes": 0, "sessions_expired": 0, "sessions_reaped": 0,
+                   "parties_reaped": 0, "images_evicted": 0,
+                   "bytes_reclaimed": 0}
+
+
+class Janitor(object):
+    """
+    Periodically reclaims the memory held in redis by records that were
+    left behind: sessions that never expire or belong to parties that have
+    ended, parties that were never finalized, and cuisine images that
+    haven't been used in a while, or that exceed the image cache's size.
+
+    The keyspace is walked with SCAN, and the deadlines with ZSCAN,
+    a batch at a time, so that redis is never blocked for long.
+    """
+
+    def __init__(self, redis, interval, batch_size, image_cap,
+                 image_max_idle):
+        """
+        Args:
+            redis:          The redis instance.
+            interval:       The number of seconds between passes.
+            batch_size:     The number of keys asked for with each scan.
+            image_cap:      The largest number of cuisines to keep images
+                            for, evicting the least recently used first.
+            image_max_idle: The number of seconds after which images that
+                            haven't been used are evicted.
+        """
+        self._redis = redis
+        self._interval = interval
+        self._batch_size = batch_size
+        self._image_cap = image_cap
+        self._image_max_idle = image_max_idle
+        # The parties found ended but not yet deleted on the last pass.
+        # A party still in that state a whole pass later is assumed to
+        # have been abandoned while being finalized.
+        self._ended_parties = set()
+        self._stopped = Event()
+        self._worker = Thread(target=self._work)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        """
+        Stops the janitor.
+        """
+        self._stopped.set()
+        self._worker.join()
+
+    def sweep(self):
+        """
+        Makes a single pass over the keyspace.
+
+        Returns:
+            A dictionary of counters for what was reclaimed in this pass.
+        """
+        counts = dict.fromkeys(_janitor_counts, 0)
+        counts["passes"] = 1
+        self._sweep_deadlines()
+        self._sweep_keys(counts)
+        self._evict_images(counts)
+        with _janitor_lock:
+            for counter, amount in counts.items():
+                _janitor_counts[counter] += amount
+        logging.info("Janitor reclaimed {0} bytes: {1}".format(
+                     counts["bytes_reclaimed"], counts))
+        return counts
+
+    def _sweep_deadlines(self):
+        """
+        Drops the deadlines of parties that no longer exist.
+        """
+        for entries in self._batches(self._redis.zscan, PARTY_DEADLINES):
+            party_names = [party_name for party_name, _ in entries]
+            pipeline = self._redis.pipeline(transaction=False)
+            for party_name in party_names:
+                pipeline.exists(party_key(party_name, "meta"))
+            gone = [party_name for party_name, exists
+                    in zip(party_names, pipeline.execute()) if not exists]
+            if gone:
+                self._redis.zrem(PARTY_DEADLINES, *gone)
+
+    def _sweep_keys(self, counts):
+        """
+        Walks the keyspace, bounding the lifetime of sessions, deleting the
+        sessions of parties that have ended and the records of parties that
+        were abandoned, and keeping track of images that predate tracking
+        their use.
+
+        Args:
+            counts: The counters for this pass.
+        """
+        ended_parties = set()
+        for keys in self._batches(self._redis.scan):
+            sessions, party_names, cuisines = [], set(), []
+            for key in keys:
+                party = parse_party_key(key)
+                if party is not None:
+                    party_names.add(party[0])
+                elif key.startswith(SESSION_PREFIX):
+                    sessions.append(key)
+                elif key.startswith(CUISINE_IMAGES_PREFIX):
+                    cuisines.append(key[len(CUISINE_IMAGES_PREFIX):])
+            self._sweep_sessions(sessions, counts)
+            ended_parties.update(self._sweep_party_keys(party_names, counts))
+            self._track_images(cuisines)
+        self._ended_parties = ended_parties
+
+    def _sweep_sessions(self, sessions, counts):
+        """
+        Sets an expiry on the sessions without one, and deletes the
+        sessions of members of parties that have ended. A creator who is
+        still choosing the party's name has a session naming a party that
+        doesn't exist yet, so only sessions that were voting are deleted.
+
+        Args:
+            sessions:   A list of the keys of sessions.
+            counts:     The counters for this pass.
+        """
+        if not sessions:
+            return
+        pipeline = self._redis.pipeline(transaction=False)
+        for key in sessions:
+            pipeline.ttl(key)
+            pipeline.hmget(key, "partyName", "previous")
+        results = pipeline.execute()
+        unbounded, party_sessions = [], []
+        pipeline = self._redis.pipeline(transaction=False)
+        for key, ttl, (party_name, previous) in zip(sessions, results[::2],
+                                                    results[1::2]):
+            if ttl is None or ttl == -1:
+                unbounded.append(key)
+            if party_name is not None and decode(previous) == "sentCuisine":
+                party_sessions.append(key)
+                pipeline.exists(party_key(decode(party_name), "meta"))
+        for key in unbounded:
+            pipeline.expire(key, SESSION_TTL)
+        counts["sessions_expired"] += len(unbounded)
+        results = pipeline.execute()
+        ended = [key for key, exists in zip(party_sessions, results)
+                 if not exists]
+        if ended:
+            counts["bytes_reclaimed"] += self._memory_usage(ended)
+            pipeline = self._redis.pipeline(transaction=False)
+            for key in ended:
+                pipeline.delete(key)
+            pipeline.execute()
+            counts["sessions_reaped"] += len(ended)
+
+    def _sweep_party_keys(self, party_names, counts):
+        """
+        Deletes the records of the parties that had ended, or that had lost
+        their hash, but still hadn't been deleted a whole pass ago. Parties
+        that ended with a deadline are left to the sweeper, which retries
+        announcing their winners.
+
+        Args:
+            party_names:    A set of the names of parties with records.
+            counts:         The counters for this pass.
+
+        Returns:
+            A list of the names of the parties that have ended.
+        """
+        if not party_names:
+            return []
+        party_names = sorted(party_names)
+        pipeline = self._redis.pipeline(transaction=False)
+        for party_name in party_names:
+            pipeline.hmget(party_key(party_name, "meta"), "quorum", "closed")
+            pipeline.zscore(PARTY_DEADLINES, party_name)
+        replies = pipeline.execute()
+        ended = [party_name for party_name, (quorum, closed), deadline
+                 in zip(party_names, replies[::2], replies[1::2])
+                 if quorum is None or (int(closed or 0) and deadline is None)]
+        for party_name in ended:
+            if party_name in self._ended_parties:
+                self._delete_party(party_name, counts)
+        return ended
+
+    def _track_images(self, cuisines):
+        """
+        Keeps track of the use of images that weren't tracked, as if they
+        had just been used.
+
+        Args:
+            cuisines:   A list of the cuisines that have images.
+        """
+        if not cuisines:
+            return
+        pipeline = self._redis.pipeline(transaction=False)
+        for cuisine in cuisines:
+            pipeline.zscore(IMAGES_ACCESSED, cuisine)
+        untracked = [cuisine for cuisine, accessed
+                     in zip(cuisines, pipeline.execute()) if accessed is None]
+        if untracked:
+            now = time.time()
+            self._redis.zadd(IMAGES_ACCESSED,
+                             *[arg for cuisine in untracked
+                               for arg in (cuisine, now)])
+
+    def _evict_images(self, counts):
+        """
+        Evicts the images that haven't been used in a while, followed by
+        the least recently used images, until at most image_cap cuisines
+        have images.
+
+        Args:
+            counts: The counters for this pass.
+        """
+        idle = self._redis.zrangebyscore(IMAGES_ACCESSED, "-inf",
+                                         time.time() - self._image_max_idle)
+        excess = self._redis.zcard(IMAGES_ACCESSED) - len(idle)
+        excess -= self._image_cap
+        if excess > 0:
+            idle += self._redis.zrange(IMAGES_ACCESSED, len(idle),
+                                       len(idle) + excess - 1)
+        for start in range(0, len(idle), self._batch_size):
+            cuisines = [decode(cuisine)
+                        for cuisine in idle[start:start + self._batch_size]]
+            keys = [CUISINE_IMAGES_PREFIX + cuisine for cuisine in cuisines]
+            counts["bytes_reclaimed"] += self._memory_usage(keys)
+            pipeline = self._redis.pipeline(transaction=False)
+            for key in keys:
+                pipeline.delete(key)
+            pipeline.zrem(IMAGES_ACCESSED, *cuisines)
+            counts["images_evicted"] += sum(pipeline.execute()[:-1])
+
+    def _delete_party(self, party_name, counts):
+        """
+        Deletes the records of a party.
+
+        Args:
+            party_name: A string representing the party's name.
+            counts:     The counters for this pass.
+        """
+        logging.info(u"Reaping the {0} Party".format(party_name))
+        counts["bytes_reclaimed"] += self._memory_usage(
+            party_keys(party_name))
+        delete_party(self._redis, party_name)
+        counts["parties_reaped"] += 1
+
+    def _memory_usage(self, keys):
+        """
+        Estimates the number of bytes held by some keys.
+
+        Args:
+            keys:   A list of keys.
+
+        Returns:
+            The number of bytes, or 0 if redis can't tell.
+        """
+        pipeline = self._redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.execute_command("MEMORY", "USAGE", key)
+        try:
+            return sum(usage or 0 for usage in
+                       pipeline.execute(raise_on_error=False)
+                       if not isinstance(usage, Exception))
+        except Exception:
+            return 0
+
+    def _batches(self, scan, *args):
+        """
+        Iterates over a scan a batch at a time.
+
+        Args:
+            scan:   The redis method that scans, SCAN, SSCAN or ZSCAN.
+            args:   The arguments passed before the cursor.
+
+        Yields:
+            A list of the items returned by each call, with keys and
+            members decoded.
+        """
+        cursor = None
+        while cursor != 0:
+            cursor, items = scan(*(args + (cursor or 0,)),
+                                 count=self._batch_size)
+            cursor = int(cursor)
+            if items:
+                yield [(decode(item[0]), item[1])
+                       if isinstance(item, tuple) else decode(item)
+                       for item in items]
+
+    def _work(self):
+        """
+        Makes a pass every interval until told to stop.
+        """
+        while not self._stopped.wait(self._interval):
+            try:
+                self.sweep()
+            except Exception as error:
+                logging.error("Janitor could not reclaim memory: " +
+                              str(error))
+
+
+def janitor_stats():
+    """
+    Returns counters for what this process's janitor has reclaimed.
+    """
+    with _janitor_lock:
+        return dict(_janitor_counts)
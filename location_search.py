@@ -1,4 +1,4 @@
-from flask import Blueprint, make_response, request
+from flask import Blueprint, current_app, make_response, request
 from flask_cors import cross_origin
 
 import json
@@ -7,6 +7,9 @@ import os
 import requests
 import yaml
 
+from caching import PrefixIndex, TTLCache
+from storage import decode
+
 
 find_similar_locations_blueprint = Blueprint("fsl_blueprint", __name__)
 
@@ -17,10 +20,10 @@ find_similar_locations_blueprint = Blueprint("fsl_blueprint", __name__)
 def find_similar_locations_www():
     # Setting a CORS header along with a blueprint seems to force Flask
     # into thinking that app context is required, even when it isn't.
-    return find_similar_locations()
+    return find_similar_locations(redis=current_app.config["redis"])
 
 
-def find_similar_locations(location=None):
+def find_similar_locations(location=None, redis=None):
     """
     Finds locations that are similar to the provided location string.
 
@@ -28,6 +31,7 @@ def find_similar_locations(location=None):
         location: A string representing a location. If location is none,
         assume that the location is being sent in a GET request via the
         find_similar_locations_www method.
+        redis:    Reference to the redis server.
 
     Returns:
         A list of strings, each string representing a location
@@ -40,14 +44,18 @@ def find_similar_locations(location=None):
         www = True
         location = request.args.get("location")
 
-    # Use Google's Places' Autocomplete API
-    api_request = PLACES_AUTOCOMPLETE_REQUEST + location
-    response = requests.get(api_request).json()
-    locations = response["predictions"]
-    for idx in range(len(locations)):
-        place_id = locations[idx]["place_id"]
-        description = locations[idx]["description"]
-        locations[idx] = (place_id, description)
+    # Inputs that differ only by case or spacing share their predictions.
+    query = " ".join(location.lower().split())
+    locations = _predictions_cache.get(query)
+    if locations is None:
+        # As the user types, earlier predictions often complete the input.
+        locations = _prefix_index.find(query, PREDICTIONS_LIMIT)
+        if len(locations) < PREDICTIONS_LIMIT:
+            locations = _autocomplete(location, redis)
+        if locations:
+            _predictions_cache.set(query, locations)
+    # Keep callers from modifying the cached predictions.
+    locations = list(locations)
 
     # TODO: Handle the case when places API returns no matches
     if not locations:
@@ -59,22 +67,107 @@ def find_similar_locations(location=None):
         locations = json.dumps(locations)
         locations = make_response(locations)
         locations.mimetype = "application/json"
+        locations.headers["Cache-Control"] = "public, max-age={0}".format(
+            AUTOCOMPLETE_TTL)
     return locations
 
 
-def find_country_code(place_id):
+def _autocomplete(location, redis=None):
+    """
+    Asks Google's Places' Autocomplete API for locations similar to
+    the provided location string, and remembers their descriptions,
+    along with their countries when these are apparent.
+
+    Args:
+        location: A string representing a location.
+        redis:    Reference to the redis server.
+
+    Returns:
+        A list of tuples in the form (place_id, description).
+    """
+    api_request = PLACES_AUTOCOMPLETE_REQUEST + location
+    response = requests.get(api_request).json()
+    locations = response["predictions"]
+    country_codes = {}
+    for idx in range(len(locations)):
+        place_id = locations[idx]["place_id"]
+        description = locations[idx]["description"]
+        # The last term of a prediction is usually its country's name.
+        terms = locations[idx].get("terms")
+        if terms and terms[-1]["value"] in COUNTRY_NAMES:
+            country_codes[place_id] = COUNTRY_NAMES[terms[-1]["value"]]
+        locations[idx] = (place_id, description)
+    _remember_country_codes(country_codes, redis)
+    # Index the top prediction last, since the most recently added
+    # descriptions are the first to be found.
+    for place_id, description in reversed(locations):
+        _prefix_index.add(description.lower(), (place_id, description))
+    return locations
+
+
+def find_country_code(place_id, redis=None):
     """
     Finds the country code for a location with some place_id.
 
     Args:
         place_id: A string representing the identifiers that
                   Google Places uses for locations
+        redis:    Reference to the redis server.
 
     Returns:
         A string representing the country code within which
         is the location represented by place_id. The country
         code is in ISO-3166-1 alpha-2 form.
     """
+    # A place's country is usually known from when it was predicted,
+    # or from an earlier lookup.
+    country_code = _country_codes.get(place_id)
+    if country_code is None and redis:
+        country_code = decode(redis.get(COUNTRY_KEY_PREFIX + place_id))
+        if country_code is not None:
+            _country_codes.set(place_id, country_code)
+    if country_code is None:
+        country_code = _find_country_code_details(place_id)
+        if country_code is not None:
+            _remember_country_codes({place_id: country_code}, redis)
+    return country_code
+
+
+def _remember_country_codes(country_codes, redis=None):
+    """
+    Remembers the country codes for locations with some place_ids,
+    for COUNTRY_TTL seconds, in a single round trip to redis.
+
+    Args:
+        country_codes: A dictionary mapping the identifiers that Google
+                       Places uses for locations to the locations' country
+                       codes.
+        redis:         Reference to the redis server.
+    """
+    if not country_codes:
+        return
+    for place_id, country_code in country_codes.items():
+        _country_codes.set(place_id, country_code)
+    if redis:
+        pipeline = redis.pipeline(transaction=False)
+        for place_id, country_code in country_codes.items():
+            pipeline.set(COUNTRY_KEY_PREFIX + place_id, country_code,
+                         ex=COUNTRY_TTL)
+        pipeline.execute()
+
+
+def _find_country_code_details(place_id):
+    """
+    Finds the country code for a location with some place_id,
+    using Google's Places' Details API.
+
+    Args:
+        place_id: A string representing the identifiers that
+                  Google Places uses for locations
+
+    Returns:
+        A string representing the location's country code.
+    """
     # Use Google's Places' Details API
     api_request = PLACES_DETAILS_REQUEST + place_id
     response = requests.get(api_request).json()
@@ -107,3 +200,26 @@ else:
     PLACES_DETAILS_REQUEST = "".join([DETAILS_ENDPOINT,
                                       "?key=", PLACES_KEY,
                                       "&placeid="])
+
+    # Predictions are cached for the normalized input that produced them.
+    AUTOCOMPLETE_TTL = config["places"]["autocomplete_ttl"]
+    _predictions_cache = TTLCache(
+        max_size=config["places"]["autocomplete_cache_size"],
+        ttl=AUTOCOMPLETE_TTL)
+    # The number of predictions that Google returns for an input. Recent
+    # predictions are only used if there are as many that complete an input.
+    PREDICTIONS_LIMIT = config["places"]["predictions"]
+    # The descriptions of recent predictions are indexed by prefix, so that
+    # inputs that they complete needn't be sent to Google.
+    _prefix_index = PrefixIndex(max_size=config["places"]["prefix_index_size"],
+                                recent_size=PREDICTIONS_LIMIT)
+
+    # Maps the names of countries, as they appear in predictions, to their
+    # country codes. Predictions ending in any other name are looked up.
+    COUNTRY_NAMES = config["places"]["country_names"]
+    # Country codes are kept in redis under this prefix, for COUNTRY_TTL
+    # seconds, and in this process for as long as they fit.
+    COUNTRY_KEY_PREFIX = "places:country:"
+    COUNTRY_TTL = config["places"]["country_ttl"]
+    _country_codes = TTLCache(max_size=config["places"]["country_cache_size"],
+                              ttl=COUNTRY_TTL)
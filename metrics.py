@@ -0,0 +1,26 @@
+from flask import Blueprint, current_app, make_response
+
+from image_finder import fetch_stats
+from janitor import janitor_stats
+from storage import store_stats
+from yelp_search import eatery_cache_stats
+
+import json
+
+
+metrics_blueprint = Blueprint("metrics", __name__)
+
+
+@metrics_blueprint.route("/metrics")
+def send_metrics():
+    """
+    Returns a response containing this process's internal counters.
+    """
+    metrics = {"image_fetches": fetch_stats(),
+               "eatery_cache": eatery_cache_stats(),
+               "janitor": janitor_stats(),
+               "store": store_stats(current_app.config.get("redis"))}
+    response = json.dumps(metrics)
+    response = make_response(response)
+    response.mimetype = "application/json"
+    return response
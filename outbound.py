@@ -0,0 +1,167 @@
+import logging
+import time
+import zlib
+
+from concurrent.futures import Future
+from queue import Queue
+from threading import Lock, Thread
+
+
+# Placed on a sender's queue to tell the sender to stop.
+_STOP = object()
+
+
+class OutboundDispatcher(object):
+    """
+    Delivers outbound messages from a pool of sender threads, so that
+    the webhook doesn't have to wait on Twilio's API.
+
+    Each recipient is always served by the same sender, which means that
+    messages reach a recipient in the order in which they were queued.
+    """
+
+    def __init__(self, send, workers, retries, backoff, should_retry=None):
+        """
+        Args:
+            send:           A function that delivers a single message, called
+                            with the arguments passed to enqueue.
+            workers:        The number of sender threads.
+            retries:        The number of times to retry a failed delivery.
+            backoff:        The number of seconds to wait before the first
+                            retry, doubled for each retry that follows.
+            should_retry:   A function that is passed the exception raised by
+                            a failed delivery and returns whether to retry.
+        """
+        self._send = send
+        self._retries = retries
+        self._backoff = backoff
+        self._should_retry = should_retry or (lambda error: True)
+        self._queues = [Queue() for _ in range(workers)]
+        self._senders = []
+        for queue in self._queues:
+            sender = Thread(target=self._work, args=(queue,))
+            sender.daemon = True
+            sender.start()
+            self._senders.append(sender)
+
+    def enqueue(self, to, *args, **kwargs):
+        """
+        Queues a message for delivery.
+
+        Args:
+            to:     The recipient's phone number.
+            args:   Further positional arguments passed on to send.
+            kwargs: Keyword arguments passed on to send.
+
+        Returns:
+            A Future, resolved once the message has been delivered, or
+            failed with the error that kept the message from being delivered.
+        """
+        delivery = Future()
+        # Use a stable hash, so that a recipient always maps to one sender.
+        idx = zlib.crc32(to.encode("utf-8")) % len(self._queues)
+        self._queues[idx].put((to, args, kwargs, delivery))
+        return delivery
+
+    def pending(self):
+        """
+        Returns the number of messages waiting to be delivered.
+        """
+        return sum(queue.qsize() for queue in self._queues)
+
+    def drain(self, timeout=None):
+        """
+        Stops the senders once every queued message has been delivered.
+
+        Args:
+            timeout:    The maximum number of seconds to wait for the
+                        senders to finish.
+        """
+        for queue in self._queues:
+            queue.put(_STOP)
+        deadline = None if timeout is None else time.time() + timeout
+        for sender in self._senders:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            sender.join(remaining)
+        if self.pending():
+            logging.error("Outbound messages left undelivered: {0}".format(
+                          self.pending()))
+
+    def _work(self, queue):
+        """
+        Delivers messages from a queue until told to stop.
+
+        Args:
+            queue:  The sender's queue of messages.
+        """
+        while True:
+            message = queue.get()
+            if message is _STOP:
+                return
+            to, args, kwargs, delivery = message
+            self._deliver(to, args, kwargs, delivery)
+
+    def _deliver(self, to, args, kwargs, delivery):
+        """
+        Delivers a message, retrying with exponential backoff on failure.
+
+        Args:
+            to:         The recipient's phone number.
+            args:       Further positional arguments passed on to send.
+            kwargs:     Keyword arguments passed on to send.
+            delivery:   The Future to resolve once the message is delivered.
+        """
+        attempt = 0
+        while True:
+            try:
+                self._send(to, *args, **kwargs)
+                delivery.set_result(None)
+                return
+            except Exception as error:
+                if attempt >= self._retries or not self._should_retry(error):
+                    logging.error(u"Could not send message to {0}: {1}".format(
+                                  to, error))
+                    delivery.set_exception(error)
+                    return
+                time.sleep(self._backoff * 2 ** attempt)
+                attempt += 1
+
+
+def gather_deliveries(deliveries):
+    """
+    Combines the deliveries of messages to several recipients.
+
+    Args:
+        deliveries: A dictionary mapping each recipient's phone number to a
+                    list of the Futures returned when queueing the recipient's
+                    messages.
+
+    Returns:
+        A Future, resolved once every message has been delivered or has
+        failed, with a dictionary mapping each recipient's phone number to
+        the error that kept one of the recipient's messages from being
+        delivered, or to None if all of them were delivered.
+    """
+    report = Future()
+    results = dict((to, None) for to in deliveries)
+    remaining = [sum(len(futures) for futures in deliveries.values())]
+    lock = Lock()
+
+    def record(to, delivery):
+        with lock:
+            if delivery.exception() is not None:
+                results[to] = delivery.exception()
+            remaining[0] -= 1
+            done = remaining[0] == 0
+        if done:
+            report.set_result(results)
+
+    if not remaining[0]:
+        report.set_result(results)
+    for to, futures in deliveries.items():
+        for delivery in futures:
+            delivery.add_done_callback(
+                lambda delivery, to=to: record(to, delivery))
+    return report
@@ -0,0 +1,568 @@
+import json
+import logging
+import time
+import yaml
+
+from storage import PARTY_DEADLINES, decode, party_key, party_keys
+from storage import script_fallback
+from winner_logic import find_leaders
+
+
+# The possible outcomes of a vote.
+# The vote was counted, and the party carries on.
+VOTE_COUNTED = "counted"
+# The vote was counted, and with it the party has reached its quorum.
+# Whoever cast this vote is responsible for announcing the winner.
+PARTY_CLOSED = "closed"
+# The party had already ended, so the vote was ignored.
+PARTY_OVER = "over"
+
+# Records a vote in a single round trip, so that votes arriving at the same
+# time can't be lost or counted twice, and so that only one vote closes
+# the party. Whoever closes the party holds a lease on announcing its
+# winner until the time in its "finalizing_until" field, after which the
+# announcement may be taken over, should it have failed.
+# When leaders are tracked, the cuisines tied for the highest score are kept
+# in a set, and the highest score in the party's hash. The set only has to
+# be rebuilt from the scores when its last cuisine loses the lead.
+# A counted vote also returns the party's tallies, so that the member's
+# next image can be picked without reading them again.
+# Every key belongs to the party, so the script runs within a single slot.
+#   KEYS: {party:<party>}:meta, {party:<party>}:scores,
+#         {party:<party>}:leaders, {party:<party>}:shown
+#   ARGV: cuisine, score, "1" to track leaders, the time at which the lease
+#         on announcing the winner ends
+_VOTE_SCRIPT = """
+local state = redis.call("HMGET", KEYS[1], "quorum", "closed")
+if not state[1] or tonumber(state[2] or 0) > 0 then
+    return {"over"}
+end
+local score = tonumber(redis.call("ZINCRBY", KEYS[2], ARGV[2], ARGV[1]))
+if ARGV[3] == "1" then
+    local lead = tonumber(redis.call("HGET", KEYS[1], "leader_score"))
+    if lead and score > lead then
+        redis.call("DEL", KEYS[3])
+        redis.call("SADD", KEYS[3], ARGV[1])
+        redis.call("HSET", KEYS[1], "leader_score", score)
+    elseif lead and score == lead then
+        redis.call("SADD", KEYS[3], ARGV[1])
+    elseif not lead or (redis.call("SREM", KEYS[3], ARGV[1]) == 1
+                        and redis.call("SCARD", KEYS[3]) == 0) then
+        local top = redis.call("ZREVRANGE", KEYS[2], 0, 0, "WITHSCORES")
+        redis.call("DEL", KEYS[3])
+        redis.call("SADD", KEYS[3], unpack(
+            redis.call("ZRANGEBYSCORE", KEYS[2], top[2], top[2])))
+        redis.call("HSET", KEYS[1], "leader_score", top[2])
+    end
+end
+local party = redis.call("HMGET", KEYS[1],
+                         "images_sent", "quorum", "cuisines")
+if tonumber(party[1]) >= tonumber(party[2]) then
+    redis.call("HSET", KEYS[1], "closed", 1)
+    redis.call("HSET", KEYS[1], "finalizing_until", ARGV[4])
+    redis.call("HINCRBY", KEYS[1], "finalize_attempts", 1)
+    return {"closed"}
+end
+return {"counted", party[3],
+        redis.call("HINCRBY", KEYS[1], "images_sent", 1), party[2],
+        redis.call("ZRANGE", KEYS[2], 0, -1, "WITHSCORES"),
+        redis.call("HGETALL", KEYS[4])}
+"""
+
+# Closes a party that exists, and takes the lease on announcing its winner
+# unless someone else holds it. Returns the number of attempts to announce
+# the winner, counting this one, or 0 if the lease is held by someone else.
+#   KEYS: {party:<party>}:meta
+#   ARGV: the current time, the time at which the lease ends
+_CLOSE_SCRIPT = """
+if redis.call("HEXISTS", KEYS[1], "quorum") == 0 then
+    return 0
+end
+local lease = tonumber(redis.call("HGET", KEYS[1], "finalizing_until") or 0)
+if lease > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call("HSET", KEYS[1], "closed", 1)
+redis.call("HSET", KEYS[1], "finalizing_until", ARGV[2])
+return redis.call("HINCRBY", KEYS[1], "finalize_attempts", 1)
+"""
+
+
+@script_fallback(_VOTE_SCRIPT)
+def _vote(store, keys, args):
+    """
+    Runs _VOTE_SCRIPT on a store that can't run Lua.
+    """
+    meta, scores, leaders, shown = keys
+    cuisine, score, track, lease = args
+    quorum, closed = store.hmget(meta, "quorum", "closed")
+    if quorum is None or int(closed or 0) > 0:
+        return [PARTY_OVER]
+    score = store.zincrby(scores, cuisine, score)
+    if str(track) == "1":
+        lead = store.hget(meta, "leader_score")
+        lead = None if lead is None else float(lead)
+        if lead is not None and score > lead:
+            store.delete(leaders)
+            store.sadd(leaders, cuisine)
+            store.hset(meta, "leader_score", score)
+        elif lead is not None and score == lead:
+            store.sadd(leaders, cuisine)
+        elif lead is None or (store.srem(leaders, cuisine) == 1 and
+                              not store.smembers(leaders)):
+            _, top = store.zrevrange(scores, 0, 0, withscores=True)[0]
+            store.delete(leaders)
+            store.sadd(leaders, *store.zrangebyscore(scores, top, top))
+            store.hset(meta, "leader_score", top)
+    images_sent, quorum, cuisines = store.hmget(meta, "images_sent",
+                                                "quorum", "cuisines")
+    if int(images_sent) >= int(quorum):
+        store.hset(meta, "closed", 1)
+        store.hset(meta, "finalizing_until", lease)
+        store.hincrby(meta, "finalize_attempts", 1)
+        return [PARTY_CLOSED]
+    return [VOTE_COUNTED, cuisines,
+            store.hincrby(meta, "images_sent", 1), quorum,
+            [value for pair in store.zrange(scores, 0, -1, withscores=True)
+             for value in pair],
+            [value for pair in store.hgetall(shown).items()
+             for value in pair]]
+
+
+@script_fallback(_CLOSE_SCRIPT)
+def _close(store, keys, args):
+    """
+    Runs _CLOSE_SCRIPT on a store that can't run Lua.
+    """
+    now, lease = args
+    if not store.hexists(keys[0], "quorum"):
+        return 0
+    if float(store.hget(keys[0], "finalizing_until") or 0) > float(now):
+        return 0
+    store.hset(keys[0], "closed", 1)
+    store.hset(keys[0], "finalizing_until", lease)
+    return store.hincrby(keys[0], "finalize_attempts", 1)
+
+
+# Creates a party, unless there's a party with the same name that hasn't
+# been deleted yet, clearing out whatever else is left of an earlier party
+# with that name. Returns 1 if the party was created.
+#   KEYS: {party:<party>}:meta, {party:<party>}:scores,
+#         {party:<party>}:members, {party:<party>}:leaders,
+#         {party:<party>}:shown
+#   ARGV: location, cuisines in JSON, quorum, "1" to track leaders,
+#         seconds for which members are kept, creator, and then each cuisine
+_CREATE_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+redis.call("DEL", KEYS[2], KEYS[3], KEYS[4], KEYS[5])
+for i = 7, #ARGV do
+    redis.call("ZADD", KEYS[2], 0, ARGV[i])
+    if ARGV[4] == "1" then
+        redis.call("SADD", KEYS[4], ARGV[i])
+    end
+end
+redis.call("SADD", KEYS[3], ARGV[6])
+redis.call("EXPIRE", KEYS[3], ARGV[5])
+redis.call("HMSET", KEYS[1], "location", ARGV[1], "cuisines", ARGV[2],
+           "quorum", ARGV[3], "images_sent", 0)
+if ARGV[4] == "1" then
+    redis.call("HSET", KEYS[1], "leader_score", 0)
+end
+return 1
+"""
+
+
+@script_fallback(_CREATE_SCRIPT)
+def _create(store, keys, args):
+    """
+    Runs _CREATE_SCRIPT on a store that can't run Lua.
+    """
+    meta, scores, members, leaders, shown = keys
+    location, cuisines, quorum, track, members_ttl, creator = args[:6]
+    if store.exists(meta):
+        return 0
+    store.delete(scores, members, leaders, shown)
+    for cuisine in args[6:]:
+        store.zadd(scores, cuisine, 0)
+        if str(track) == "1":
+            store.sadd(leaders, cuisine)
+    store.sadd(members, creator)
+    store.expire(members, int(members_ttl))
+    store.hmset(meta, {"location": location, "cuisines": cuisines,
+                       "quorum": quorum, "images_sent": 0})
+    if str(track) == "1":
+        store.hset(meta, "leader_score", 0)
+    return 1
+
+
+# The prefixes of the keys in which each party's records were kept before,
+# suffixed with the party's name, and the parts of the records they hold.
+_LEGACY_PREFIXES = (("party:", "meta"), ("scores:", "scores"),
+                    ("members:", "members"), ("leaders:", "leaders"),
+                    ("shown:", "shown"))
+
+
+def create_party(redis, party_name, location, cuisines, quorum, deadline,
+                 creator):
+    """
+    Creates a party, with the party's creator as its first member.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+        location:   A string representing the party's location.
+        cuisines:   A list of strings of the cuisines allotted to the party.
+        quorum:     The number of images to send to the party's members
+                    before picking a winner.
+        deadline:   The time, in seconds since the epoch, at which a winner
+                    is picked if the quorum hasn't been reached by then.
+        creator:    The phone number of the party's creator.
+
+    Returns:
+        A boolean, False if there's already a party with that name whose
+        records haven't been deleted yet.
+    """
+    # The party's location, cuisines and quorum are kept together in a
+    # hash, along with the number of images sent to the party's members.
+
+    # Can't store party scores in a redis hash, since the values
+    # will have to be serialized in JSON. This will in turn cause
+    # issues with concurrency when keeping track of votes from
+    # different users.
+
+    # This pollutes the redis key space. An alternate approach
+    # could be to keep individual scores for each user and then
+    # add the scores up once voting is complete. However, some
+    # users will finish voting before others. Users that finish
+    # voting should be free to join other sessions, rather than
+    # be blocked. Keeping this in mind, using individual scores
+    # leads to the same concurrency issues with using a redis hash.
+
+    # Use a redis sorted set to keep track of the scores of the cuisines
+    # allotted to a party. Each cuisine starts off with a score of zero.
+    # Similarly, in the case that we have multiple members joining
+    # a party at the same time, we need to be able to atomically
+    # modify the members in any given party.
+
+    # When leaders are tracked, every cuisine leads with a score of zero
+    # before any votes are cast.
+
+    # The party's keys are written at once, so that no one sees a party
+    # that is half created, or mixed with an earlier party of that name.
+    create = redis.register_script(_CREATE_SCRIPT)
+    created = create(keys=party_keys(party_name),
+                     args=[location, json.dumps(cuisines), quorum,
+                           int(TRACK_LEADERS),
+                           int(deadline - time.time()) + 3600, creator] +
+                     list(cuisines))
+    if not created:
+        return False
+    # The deadlines are kept apart from the party's own keys, in another
+    # slot, so the party's deadline is only set once the party exists.
+    redis.zadd(PARTY_DEADLINES, party_name, deadline)
+    return True
+
+
+def party_exists(redis, party_name):
+    """
+    Determines whether there is an active party with some name.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing a party name.
+
+    Returns:
+        A boolean, indicating whether the party exists.
+    """
+    quorum, closed = redis.hmget(party_key(party_name, "meta"),
+                                 "quorum", "closed")
+    return quorum is not None and not int(closed or 0)
+
+
+def party_name_taken(redis, party_name):
+    """
+    Determines whether a party name is in use, by a party that's active or
+    by one that has ended but whose records haven't been deleted yet.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing a party name.
+
+    Returns:
+        A boolean, indicating whether the name is taken.
+    """
+    return bool(redis.exists(party_key(party_name, "meta")))
+
+
+def join_party(redis, party_name, member):
+    """
+    Adds a member to a party.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+        member:     The new member's phone number.
+
+    Returns:
+        A list of strings of the cuisines allotted to the party,
+        or None if the party has ended.
+    """
+    pipeline = redis.pipeline()
+    pipeline.sadd(party_key(party_name, "members"), member)
+    pipeline.hmget(party_key(party_name, "meta"), "cuisines", "closed")
+    _, (cuisines, closed) = pipeline.execute()
+    if cuisines is None or int(closed or 0):
+        redis.srem(party_key(party_name, "members"), member)
+        return None
+    return json.loads(cuisines)
+
+
+def count_party_image(redis, party_name, cuisine):
+    """
+    Counts an image sent to one of a party's members.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+        cuisine:    A string representing the cuisine of the image.
+    """
+    pipeline = redis.pipeline()
+    pipeline.hincrby(party_key(party_name, "meta"), "images_sent", 1)
+    pipeline.hincrby(party_key(party_name, "shown"), cuisine, 1)
+    pipeline.execute()
+
+
+def count_party_cuisine(redis, party_name, cuisine):
+    """
+    Counts an image of a cuisine sent to one of a party's members, once the
+    image itself has been counted when recording a vote.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+        cuisine:    A string representing the cuisine of the image.
+    """
+    redis.hincrby(party_key(party_name, "shown"), cuisine, 1)
+
+
+def get_party_results(redis, party_name):
+    """
+    Gets what's needed to announce the winner of a party, besides the
+    winner itself, which is picked from get_party_leaders.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+
+    Returns:
+        A tuple in the form (location, members), where location is the
+        party's location, and members is a set of the phone numbers of the
+        party's members.
+    """
+    pipeline = redis.pipeline()
+    pipeline.hget(party_key(party_name, "meta"), "location")
+    pipeline.smembers(party_key(party_name, "members"))
+    location, members = pipeline.execute()
+    return decode(location), members
+
+
+def get_party_leaders(redis, party_name):
+    """
+    Gets the cuisines currently leading a party's vote. When leaders are
+    tracked, these are kept up to date as votes are cast, so that they are
+    read without going through the party's scores.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+
+    Returns:
+        A tuple in the form (leaders, score), where leaders is a list of the
+        cuisines tied for the highest score, and score is that score, or
+        None if the party has no scores.
+    """
+    if not TRACK_LEADERS:
+        return find_leaders(redis.zrange(party_key(party_name, "scores"),
+                                         0, -1, withscores=True))
+    pipeline = redis.pipeline()
+    pipeline.smembers(party_key(party_name, "leaders"))
+    pipeline.hget(party_key(party_name, "meta"), "leader_score")
+    leaders, score = pipeline.execute()
+    if score is None:
+        return [], None
+    return [decode(cuisine) for cuisine in leaders], float(score)
+
+
+def close_party(redis, party_name):
+    """
+    Closes a party to further votes, ahead of its quorum, or takes over the
+    announcement of the winner of a party that was closed FINALIZE_LEASE
+    seconds ago without being deleted since.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+
+    Returns:
+        The number of attempts to announce the party's winner, counting this
+        one, for the one caller who is then responsible for announcing the
+        winner, and 0 for everyone else.
+    """
+    now = time.time()
+    close = redis.register_script(_CLOSE_SCRIPT)
+    attempt = close(keys=[party_key(party_name, "meta")],
+                    args=[now, now + FINALIZE_LEASE])
+    if attempt:
+        _retry_finalize_at(redis, party_name, now + FINALIZE_LEASE)
+    return int(attempt)
+
+
+def _retry_finalize_at(redis, party_name, when):
+    """
+    Moves a closed party's deadline to when its lease on announcing the
+    winner ends. The deadline is only dropped once the party is deleted,
+    so that the sweeper retries an announcement that failed.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+        when:       The time, in seconds since the epoch, at which to retry.
+    """
+    redis.zadd(PARTY_DEADLINES, party_name, when)
+
+
+def get_expired_parties(redis, now):
+    """
+    Gets the parties that are past their deadlines.
+
+    Args:
+        redis:      The redis instance.
+        now:        The current time, in seconds since the epoch.
+
+    Returns:
+        A list of the names of the parties.
+    """
+    return [decode(party_name)
+            for party_name in redis.zrangebyscore(PARTY_DEADLINES,
+                                                  "-inf", now)]
+
+
+def delete_party(redis, party_name):
+    """
+    Deletes the records of a party.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+    """
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.delete(*party_keys(party_name))
+    pipeline.zrem(PARTY_DEADLINES, party_name)
+    pipeline.execute()
+
+
+def migrate_parties(redis):
+    """
+    Moves each active party out of the global set of parties, and out of
+    the hashes and keys in which the party's records were kept before, and
+    into keys tagged with the party's name.
+
+    Args:
+        redis:      The redis instance.
+    """
+    for party_name in redis.smembers("parties"):
+        party_name = decode(party_name)
+        pipeline = redis.pipeline()
+        pipeline.hget("parties:locations", party_name)
+        pipeline.hget("parties:cuisines", party_name)
+        pipeline.hget("parties:quorums", party_name)
+        pipeline.zscore("parties:images_sent", party_name)
+        location, cuisines, quorum, images_sent = pipeline.execute()
+        if cuisines is not None:
+            pipeline = redis.pipeline()
+            pipeline.hmset(u"party:" + party_name, {"location": location,
+                                                    "cuisines": cuisines,
+                                                    "quorum": quorum,
+                                                    "images_sent":
+                                                    int(images_sent or 0)})
+            pipeline.hdel("parties:locations", party_name)
+            pipeline.hdel("parties:cuisines", party_name)
+            pipeline.hdel("parties:quorums", party_name)
+            pipeline.zrem("parties:images_sent", party_name)
+            pipeline.execute()
+        # Keys are renamed before the keyspace is split into slots.
+        for prefix, part in _LEGACY_PREFIXES:
+            if redis.exists(prefix + party_name):
+                redis.rename(prefix + party_name, party_key(party_name, part))
+        # Parties created before deadlines end as they would have,
+        # but are bounded by a deadline too.
+        if redis.zscore(PARTY_DEADLINES, party_name) is None:
+            redis.zadd(PARTY_DEADLINES, party_name,
+                       time.time() + MAX_DURATION)
+        redis.srem("parties", party_name)
+
+
+def record_party_vote(redis, party_name, cuisine, score):
+    """
+    Records a party member's vote for a cuisine and, unless the vote brings
+    the party to its quorum, counts the next image sent to the member.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the member's party name.
+        cuisine:    A string representing the cuisine voted on.
+        score:      The vote, 1 for a cuisine the member likes, -1 for
+                    a cuisine the member dislikes, or 0 for neither.
+
+    Returns:
+        A tuple in the form (outcome, party), where outcome is one of
+        VOTE_COUNTED, PARTY_CLOSED or PARTY_OVER, and party is None unless
+        the vote was counted. Otherwise, party is a dictionary of the
+        party's "cuisines", its "scores" as a list of tuples in the form
+        (cuisine, score) sorted in ascending order of score, how many times
+        each cuisine has been "shown", and its "images_sent" and "quorum",
+        as they were right after the vote.
+    """
+    lease = time.time() + FINALIZE_LEASE
+    vote = redis.register_script(_VOTE_SCRIPT)
+    result = vote(keys=[party_key(party_name, "meta"),
+                        party_key(party_name, "scores"),
+                        party_key(party_name, "leaders"),
+                        party_key(party_name, "shown")],
+                  args=[cuisine, score, int(TRACK_LEADERS), lease])
+    outcome = decode(result[0])
+    if outcome == PARTY_CLOSED:
+        _retry_finalize_at(redis, party_name, lease)
+    if outcome != VOTE_COUNTED:
+        return outcome, None
+    _, cuisines, images_sent, quorum, scores, shown = result
+    party = {"cuisines": json.loads(decode(cuisines)),
+             "scores": [(decode(scores[i]), float(scores[i + 1]))
+                        for i in range(0, len(scores), 2)],
+             "shown": dict((decode(shown[i]), int(shown[i + 1]))
+                           for i in range(0, len(shown), 2)),
+             "images_sent": int(images_sent),
+             "quorum": int(quorum)}
+    return outcome, party
+
+
+try:
+    with open("config", "r") as stream:
+        config = yaml.safe_load(stream)
+
+except Exception as error:
+    logging.error("Something wrong with the config file, " + str(error))
+
+else:
+    # Keep track of each party's leading cuisines as votes are cast.
+    TRACK_LEADERS = config["quorum"]["track_leaders"]
+    # The longest that a party can last, in seconds.
+    MAX_DURATION = config["parties"]["max_duration"] * 60
+    # Seconds for which whoever closes a party has to announce its winner,
+    # before the announcement is retried.
+    FINALIZE_LEASE = config["parties"]["finalize_lease"]
+    # The number of attempts to announce a party's winner before the party
+    # is given up on.
+    MAX_FINALIZE_ATTEMPTS = config["parties"]["finalize_attempts"]
@@ -1,6 +1,8 @@
 from flask import Blueprint, current_app
 import random
 
+from parties import party_name_taken
+
 generate_party_name_blueprint = Blueprint("generate_name_blueprint", __name__)
 
 
@@ -20,13 +22,13 @@ def generate_party_name():
     party_name = adjective + food_name
     retries = 0
     # If the party name is taken, keep trying to find a new name
-    while redis.sismember("parties", party_name) and retries < 5:
+    while party_name_taken(redis, party_name) and retries < 5:
         adjective = redis.srandmember("adjectives").strip()
         food_name = redis.srandmember("foodnames").strip()
         party_name = adjective + food_name
         retries += 1
     # If we still haven't found a party name, well...
-    while redis.sismember("parties", party_name):
+    while party_name_taken(redis, party_name):
         pad = str(random.randint(0, 9))
         party_name += pad
     return party_name
@@ -1,11 +1,105 @@
-import json
+import atexit
 import logging
 import os
 import yaml
 
+from flask import g, has_request_context, request
+from functools import wraps
+from twilio.base.exceptions import TwilioRestException
 from twilio.rest import Client
+from twilio.twiml.messaging_response import MessagingResponse
 
 from image_finder import get_random_cuisine_image_from_redis
+from outbound import OutboundDispatcher, gather_deliveries
+from parties import count_party_image
+from sessions import delete_session, delete_sessions, start_session
+from sessions import update_session
+from storage import decode
+
+
+def replies_as_twiml(view):
+    """
+    Decorates a webhook view so that the replies sent to the user who
+    texted us are returned as TwiML, rather than sent via the REST API.
+
+    Args:
+        view:   The Flask view function handling an inbound message.
+
+    Returns:
+        The decorated view function.
+    """
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        if RESPONSE_MODE != "twiml":
+            return view(*args, **kwargs)
+        # Messages addressed to the sender of the inbound message are
+        # collected here, everyone else is messaged via the REST API.
+        g.twiml_recipient = request.form["From"]
+        g.twiml_response = MessagingResponse()
+        g.twiml_replies = 0
+        response = view(*args, **kwargs)
+        if not g.twiml_replies:
+            return response
+        return str(g.twiml_response), 200, {"Content-Type": "text/xml"}
+    return decorated_view
+
+
+def send_message(to, from_, body, media_url=None):
+    """
+    Sends a message to a user, either as part of the TwiML response to the
+    user's inbound message, or, via Twilio's REST API.
+
+    Args:
+        to:         The user's phone number.
+        from_:      Our Twilio phone number, used to communicate with users.
+        body:       A string containing the message's text.
+        media_url:  A URI, or a list of URIs, of media to attach.
+    """
+    if has_request_context() and g.get("twiml_recipient") == to:
+        message = g.twiml_response.message()
+        message.body(body)
+        if not isinstance(media_url, (list, tuple)):
+            media_url = [media_url]
+        for uri in media_url:
+            if uri:
+                message.media(uri)
+        g.twiml_replies += 1
+    elif OUTBOUND_ASYNC:
+        dispatcher.enqueue(to, from_, body, media_url)
+    else:
+        create_message(to, from_, body, media_url)
+
+
+def create_message(to, from_, body, media_url=None):
+    """
+    Sends a message to a user via Twilio's REST API.
+
+    Args:
+        to:         The user's phone number.
+        from_:      Our Twilio phone number, used to communicate with users.
+        body:       A string containing the message's text.
+        media_url:  A URI, or a list of URIs, of media to attach.
+    """
+    if media_url is None:
+        client.messages.create(to=to, from_=from_, body=body)
+    else:
+        client.messages.create(to=to, from_=from_, body=body,
+                               media_url=media_url)
+
+
+def is_retryable(error):
+    """
+    Determines whether a failed send is worth retrying.
+
+    Args:
+        error:  The exception raised while sending a message.
+
+    Returns:
+        A boolean, False if Twilio rejected the message itself.
+    """
+    if isinstance(error, TwilioRestException):
+        return error.status >= 500 or error.status == 429
+    return True
 
 
 def invalid_option_start_over(sender, from_, redis):
@@ -19,9 +113,9 @@ def invalid_option_start_over(sender, from_, redis):
         redis:  The redis instance.
     """
     response = "Invalid option. Please start again."
-    client.messages.create(to=sender, from_=from_, body=response)
+    send_message(sender, from_, response)
     if redis:
-        redis.hdel("users", sender)
+        delete_session(redis, sender)
 
 
 def send_similar_locations(sender_history, locations, sender, from_, redis):
@@ -38,18 +132,19 @@ def send_similar_locations(sender_history, locations, sender, from_, redis):
         redis:          The redis instance.
     """
     response = "Which of these do you mean?"
-    client.messages.create(to=sender, from_=from_, body=response)
+    send_message(sender, from_, response)
     for idx, location in enumerate(locations):
         # Locations are in the form (country code, address)
         # The user doesn't care to see the country code
         location = location[1]
         response = u"{0}: {1}".format(idx + 1, location)
-        client.messages.create(to=sender, from_=from_, body=response)
+        send_message(sender, from_, response)
     sender_history["ambiguousLocations"] = locations
     sender_history["previous"] = "disambiguateLocations"
-    sender_history = json.dumps(sender_history)
     if redis:
-        redis.hset("users", sender, sender_history)
+        update_session(redis, sender, fields={
+            "ambiguousLocations": locations,
+            "previous": "disambiguateLocations"})
 
 
 def send_unsupported_country(sender, from_, redis):
@@ -63,9 +158,9 @@ def send_unsupported_country(sender, from_, redis):
         redis:  The redis instance.
     """
     response = "Sorry, this location is currently not supported."
-    client.messages.create(to=sender, from_=from_, body=response)
+    send_message(sender, from_, response)
     if redis:
-        redis.hdel("users", sender)
+        delete_session(redis, sender)
 
 
 def send_first_cuisine(sender_history, sender, from_, redis):
@@ -87,16 +182,16 @@ def send_first_cuisine(sender_history, sender, from_, redis):
 
     if sender_history.get("partyName", False):
         party_name = sender_history["partyName"]
-        # Using a redis sorted set will allow us to atomically increment
+        # Using a redis hash will allow us to atomically increment
         # the counter for the number of images sent to a party.
         if redis:
-            redis.zincrby("parties:images_sent", party_name)
+            count_party_image(redis, party_name, first_cuisine)
     else:
         sender_history["scores"] = {first_cuisine: 0}
+        sender_history["shown"] = {first_cuisine: 1}
 
-    sender_history = json.dumps(sender_history)
     if redis:
-        redis.hset("users", sender, sender_history)
+        start_session(redis, sender, sender_history)
 
 
 def send_one_cuisine_image(to, from_, cuisine, redis):
@@ -112,7 +207,7 @@ def send_one_cuisine_image(to, from_, cuisine, redis):
     logging.info(cuisine)
     image = get_random_cuisine_image_from_redis(cuisine, redis)
     response = "Fork (R)ight if yumm or (L)eft if dumb"
-    client.messages.create(to=to, from_=from_, body=response, media_url=image)
+    send_message(to, from_, response, media_url=image)
 
 
 def send_winner(winner, eatery, sender, from_, redis, party=None):
@@ -129,22 +224,96 @@ def send_winner(winner, eatery, sender, from_, redis, party=None):
         party:          A string used to modify a response message, depending
                         on whether the user was part of a party.
     """
+    for response, media_url in winner_messages(winner, eatery, party):
+        send_message(sender, from_, response, media_url=media_url)
+    if redis:
+        delete_session(redis, sender)
+
+
+def send_party_winner(winner, eatery, members, from_, redis, party):
+    """
+    Sends every member of a party the cuisine which won and a suggested
+    eatery. The members are messaged concurrently by the outbound senders,
+    rather than one after the other from the caller's thread.
+
+    Args:
+        winner:         A string representing the cuisine that won.
+        eatery:         A string representing a suggested eatery.
+        members:        The phone numbers of the party's members.
+        from_:          Our Twilio phone number, used to communicate users.
+        redis:          The redis instance.
+        party:          A string representing the party's name.
+
+    Returns:
+        A Future, resolved once every message has been delivered or has
+        failed, with a dictionary mapping the phone number of each member
+        messaged via the REST API to the error that kept the member from
+        being notified, or to None if the member was notified.
+    """
+    messages = winner_messages(winner, eatery, party)
+    members = [decode(member) for member in members]
+    deliveries = {}
+    for member in members:
+        # The member whose vote ended the party is replied to directly.
+        if has_request_context() and g.get("twiml_recipient") == member:
+            for response, media_url in messages:
+                send_message(member, from_, response, media_url=media_url)
+            continue
+        deliveries[member] = [dispatcher.enqueue(member, from_, response,
+                                                 media_url)
+                              for response, media_url in messages]
+    if redis:
+        delete_sessions(redis, members)
+    report = gather_deliveries(deliveries)
+    report.add_done_callback(
+        lambda report: _log_party_deliveries(party, report.result()))
+    return report
+
+
+def winner_messages(winner, eatery, party=None):
+    """
+    Composes the messages that announce the winning cuisine.
+
+    Args:
+        winner:         A string representing the cuisine that won.
+        eatery:         A string representing a suggested eatery.
+        party:          A string used to modify a response message, depending
+                        on whether the user was part of a party.
+
+    Returns:
+        A list of tuples in the form (body, media_url).
+    """
     if party:
         response = u"".join(["The results are in for the ", party, " Party!",
                              " Looks like the party is feeling like ", winner,
                              " cuisine."])
     else:
         response = u"Looks like you might want {0} cuisine.".format(winner)
-    client.messages.create(to=sender, from_=from_, body=response)
     name = eatery["name"]
     image = eatery["image_url"] if eatery["image_url"] else None
-    response = "How about {0}?".format(name)
     logging.info(image)
     logging.info(eatery)
-    client.messages.create(to=sender, from_=from_, body=response,
-                           media_url=[image])
-    if redis:
-        redis.hdel("users", sender)
+    return [(response, None),
+            (u"How about {0}?".format(name), [image])]
+
+
+def _log_party_deliveries(party, results):
+    """
+    Logs which of a party's members could not be told the winning cuisine.
+
+    Args:
+        party:      A string representing the party's name.
+        results:    A dictionary mapping each member's phone number to the
+                    error that kept the member from being notified, or to
+                    None if the member was notified.
+    """
+    failed = dict((member, error) for member, error in results.items()
+                  if error is not None)
+    logging.info(u"Notified {0} of {1} members of the {2} Party".format(
+                 len(results) - len(failed), len(results), party))
+    for member, error in failed.items():
+        logging.error(u"Could not notify {0} of the {1} Party's winner: "
+                      u"{2}".format(member, party, error))
 
 
 try:
@@ -159,3 +328,18 @@ else:
     account_sid = os.environ.get("TWILIO_ACCOUNT_SID")
     auth_token = os.environ.get("TWILIO_KEY")
     client = Client(account_sid, auth_token)
+
+    # Either "twiml", to reply to an inbound message within the webhook's
+    # response, or "rest", to send every message via Twilio's REST API.
+    RESPONSE_MODE = config["twilio"]["response_mode"]
+
+    # Messages sent via the REST API are handed off to a pool of senders,
+    # rather than being sent from the request's thread.
+    OUTBOUND_ASYNC = config["outbound"]["async"]
+    dispatcher = OutboundDispatcher(create_message,
+                                    workers=config["outbound"]["workers"],
+                                    retries=config["outbound"]["retries"],
+                                    backoff=config["outbound"]["backoff"],
+                                    should_retry=is_retryable)
+    # Deliver whatever is still queued before the process exits.
+    atexit.register(dispatcher.drain, config["outbound"]["drain_timeout"])
@@ -81,7 +81,8 @@ def send_solo_winner_to_www():
     # Compute the winning cuisine.
     winning_cuisine = pick_solo_winner(scores)
     # Find the winning eatery.
-    eatery = find_eatery(winning_cuisine, location)
+    redis = current_app.config["redis"]
+    eatery = find_eatery(winning_cuisine, location, redis)
     # Eateries can belong in multiple categories.
     # We'll set the cuisine type that we used to determine the winner,
     # so that we can tell the user of the winning cuisine.
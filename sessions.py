@@ -0,0 +1,248 @@
+import json
+import logging
+import yaml
+
+from storage import decode, script_fallback, session_key
+
+
+# Fields of a session that hold lists, which are stored in JSON.
+JSON_FIELDS = {"ambiguousLocations", "cuisines"}
+# Fields of a session that hold counters.
+INT_FIELDS = {"imagesSent", "partyDuration", "partyQuorum"}
+# A solo user's score for a cuisine is kept in a field named after the
+# cuisine, prefixed with this.
+SCORE_PREFIX = "score:"
+# Likewise for the number of times that the user was sent the cuisine.
+SHOWN_PREFIX = "shown:"
+# Maps the prefixes of per-cuisine counters to the keys of the session
+# history under which the counters are gathered.
+CUISINE_COUNTERS = {SCORE_PREFIX: "scores", SHOWN_PREFIX: "shown"}
+
+# Updates a session only if it still exists, so that a message handled while
+# the session is deleted, say by the end of the user's party, can't bring
+# back part of the session.
+#   KEYS: users:<sender>
+#   ARGV: the session's lifetime, the number of fields to set followed by
+#         the fields and their values, the number of counters to increment
+#         followed by the counters and their increments, and then the
+#         fields to delete
+_UPDATE_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+local idx = 3
+for _ = 1, tonumber(ARGV[2]) do
+    redis.call("HSET", KEYS[1], ARGV[idx], ARGV[idx + 1])
+    idx = idx + 2
+end
+local increments = tonumber(ARGV[idx])
+idx = idx + 1
+for _ = 1, increments do
+    redis.call("HINCRBY", KEYS[1], ARGV[idx], ARGV[idx + 1])
+    idx = idx + 2
+end
+for i = idx, #ARGV do
+    redis.call("HDEL", KEYS[1], ARGV[i])
+end
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+return 1
+"""
+
+
+@script_fallback(_UPDATE_SCRIPT)
+def _update(store, keys, args):
+    """
+    Runs _UPDATE_SCRIPT on a store that can't run Lua.
+    """
+    if not store.exists(keys[0]):
+        return 0
+    idx = 2
+    for _ in range(int(args[1])):
+        store.hset(keys[0], args[idx], args[idx + 1])
+        idx += 2
+    increments = int(args[idx])
+    idx += 1
+    for _ in range(increments):
+        store.hincrby(keys[0], args[idx], args[idx + 1])
+        idx += 2
+    if args[idx:]:
+        store.hdel(keys[0], *args[idx:])
+    store.expire(keys[0], args[0])
+    return 1
+
+
+def load_session(redis, sender):
+    """
+    Loads a user's session history, and extends the session's lifetime.
+
+    Args:
+        redis:  The redis instance.
+        sender: The user's phone number.
+
+    Returns:
+        A dictionary containing the user's session history, with the user's
+        scores gathered under "scores" and the number of times each cuisine
+        was sent under "shown", or None if the user has no session.
+    """
+    fields = redis.hgetall(session_key(sender))
+    if not fields:
+        return _migrate_session(redis, sender)
+    if not any(decode(field) == "previous" for field in fields):
+        # What's left of a session that was deleted while being updated
+        # can't be resumed, so the user starts over.
+        logging.warning(u"Dropping the incomplete session of " + sender)
+        delete_session(redis, sender)
+        return None
+    redis.expire(session_key(sender), SESSION_TTL)
+    sender_history = {}
+    for field, value in fields.items():
+        field, value = decode(field), decode(value)
+        prefix = field[:field.find(":") + 1]
+        if prefix in CUISINE_COUNTERS:
+            counters = sender_history.setdefault(CUISINE_COUNTERS[prefix], {})
+            counters[field[len(prefix):]] = int(value)
+        elif field in JSON_FIELDS:
+            sender_history[field] = json.loads(value)
+        elif field in INT_FIELDS:
+            sender_history[field] = int(value)
+        else:
+            sender_history[field] = value
+    return sender_history
+
+
+def start_session(redis, sender, sender_history):
+    """
+    Replaces whatever session the user had with a new session.
+
+    Args:
+        redis:          The redis instance.
+        sender:         The user's phone number.
+        sender_history: A dictionary containing the user's session history.
+    """
+    pipeline = redis.pipeline()
+    pipeline.delete(session_key(sender))
+    pipeline.hmset(session_key(sender), _encode(sender_history))
+    pipeline.expire(session_key(sender), SESSION_TTL)
+    pipeline.execute()
+
+
+def update_session(redis, sender, fields=None, increments=None, deleted=()):
+    """
+    Updates some of the fields of a user's session, and extends the
+    session's lifetime, unless the session has since been deleted.
+
+    Args:
+        redis:      The redis instance.
+        sender:     The user's phone number.
+        fields:     A dictionary mapping the fields to set to their values.
+        increments: A dictionary mapping the counters to increment to the
+                    amounts by which to increment them.
+        deleted:    The fields to delete.
+    """
+    fields = _encode(fields or {})
+    increments = increments or {}
+    args = [SESSION_TTL, len(fields)]
+    for field, value in fields.items():
+        args.extend([field, value])
+    args.append(len(increments))
+    for field, amount in increments.items():
+        args.extend([field, amount])
+    args.extend(deleted)
+    update = redis.register_script(_UPDATE_SCRIPT)
+    update(keys=[session_key(sender)], args=args)
+
+
+def delete_session(redis, sender):
+    """
+    Deletes a user's session.
+
+    Args:
+        redis:  The redis instance.
+        sender: The user's phone number.
+    """
+    redis.delete(session_key(sender))
+
+
+def delete_sessions(redis, senders):
+    """
+    Deletes the sessions of several users at once.
+
+    Args:
+        redis:      The redis instance.
+        senders:    The users' phone numbers.
+    """
+    # Each session is a key of its own, which may be in a slot of its own,
+    # so the sessions are deleted one at a time, in a single round trip.
+    pipeline = redis.pipeline(transaction=False)
+    for sender in senders:
+        pipeline.delete(session_key(sender))
+    pipeline.execute()
+
+
+def migrate_sessions(redis):
+    """
+    Moves every session out of the "users" hash, in which sessions
+    were kept in JSON before.
+
+    Args:
+        redis:  The redis instance.
+    """
+    for sender, _ in redis.hscan_iter("users"):
+        _migrate_session(redis, decode(sender))
+
+
+def _migrate_session(redis, sender):
+    """
+    Moves a user's session out of the "users" hash, if it's still there.
+
+    Args:
+        redis:  The redis instance.
+        sender: The user's phone number.
+
+    Returns:
+        A dictionary containing the user's session history, or None if
+        the user had no session there.
+    """
+    sender_history = redis.hget("users", sender)
+    if sender_history is None:
+        return None
+    sender_history = json.loads(sender_history)
+    start_session(redis, sender, sender_history)
+    redis.hdel("users", sender)
+    return sender_history
+
+
+def _encode(sender_history):
+    """
+    Encodes a user's session history as the fields of a redis hash.
+
+    Args:
+        sender_history: A dictionary containing the user's session history.
+
+    Returns:
+        A dictionary mapping the fields of the hash to their values.
+    """
+    prefixes = dict((key, prefix)
+                    for prefix, key in CUISINE_COUNTERS.items())
+    fields = {}
+    for field, value in sender_history.items():
+        if field in prefixes:
+            for cuisine, count in value.items():
+                fields[prefixes[field] + cuisine] = count
+        elif field in JSON_FIELDS:
+            fields[field] = json.dumps(value)
+        else:
+            fields[field] = value
+    return fields
+
+
+try:
+    with open("config", "r") as stream:
+        config = yaml.safe_load(stream)
+
+except Exception as error:
+    logging.error("Something wrong with the config file, " + str(error))
+
+else:
+    # Seconds after the user's last message at which a session expires.
+    SESSION_TTL = config["sessions"]["ttl"]
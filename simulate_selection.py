@@ -0,0 +1,79 @@
+"""
+Simulates solo users voting on cuisines, to compare how many images each
+strategy in cuisine_selection sends before a winner is picked, and how
+often the winner is the cuisine the user likes best.
+
+Usage:
+    python simulate_selection.py [--users N] [--quorum N] [--cuisines N]
+"""
+import argparse
+import random
+
+from cuisine_selection import STRATEGIES
+from winner_logic import is_decided, pick_solo_winner, solo_scores
+
+
+def simulate_user(strategy, likes, quorum, early_stop):
+    """
+    Simulates a solo user voting until a winner is picked, in the same way
+    that process_text does.
+
+    Args:
+        strategy:   The name of the strategy used to pick cuisines.
+        likes:      A dictionary mapping cuisines to the probability that
+                    the user likes an image of each.
+        quorum:     The number of images after which a winner is picked.
+        early_stop: Whether to stop once the winner can't change.
+
+    Returns:
+        A tuple in the form (images_sent, winner).
+    """
+    cuisines = sorted(likes)
+    cuisine = random.choice(cuisines)
+    scores = {cuisine: 0}
+    shown = {cuisine: 1}
+    images_sent = 1
+    while images_sent < quorum:
+        score = 1 if random.random() < likes[cuisine] else -1
+        scores[cuisine] = scores.get(cuisine, 0) + score
+        all_scores = solo_scores(cuisines, scores)
+        if early_stop and is_decided(list(all_scores.items()),
+                                     quorum - images_sent - 1):
+            break
+        cuisine = STRATEGIES[strategy](cuisines, scores, shown)
+        shown[cuisine] = shown.get(cuisine, 0) + 1
+        images_sent += 1
+    if early_stop:
+        scores = solo_scores(cuisines, scores)
+    return images_sent, pick_solo_winner(scores)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--quorum", type=int, default=10)
+    parser.add_argument("--cuisines", type=int, default=5)
+    parser.add_argument("--no-early-stop", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("{0:<10} {1:>12} {2:>12}".format("strategy", "images/user",
+                                           "favourite"))
+    for strategy in sorted(STRATEGIES):
+        # Every strategy is shown the same users.
+        random.seed(args.seed)
+        images, favourites = 0, 0
+        for _ in range(args.users):
+            likes = dict((u"cuisine {0}".format(idx), random.random())
+                         for idx in range(args.cuisines))
+            images_sent, winner = simulate_user(strategy, likes, args.quorum,
+                                                not args.no_early_stop)
+            images += images_sent
+            favourites += winner == max(likes, key=likes.get)
+        print("{0:<10} {1:>12.2f} {2:>11.1f}%".format(
+              strategy, float(images) / args.users,
+              100.0 * favourites / args.users))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,709 @@
+import bisect
+import fnmatch
+import random
+import sys
+import time
+import uuid
+
+from collections import OrderedDict
+from functools import wraps
+from queue import Empty, Queue
+from redis.exceptions import LockError, ResponseError
+from threading import RLock
+
+
+# Keys are named so that the keys used together by a single script, command
+# or transaction share a hash tag, the part of a key within braces, which
+# places them in the same slot of a Redis Cluster. Every key of a party is
+# tagged with the party's name, and every user's session is a key of its own.
+
+# Each user's session is kept in a hash, suffixed with the user's number.
+SESSION_PREFIX = "users:"
+# The keys that hold a party's records, each one tagged with the party's name.
+# "meta" is a hash of the party's location, cuisines, quorum and progress,
+# "scores" a sorted set of the cuisines' scores, "members" a set of the
+# members' numbers, "leaders" a set of the leading cuisines, and "shown" a
+# hash of the number of times each cuisine was sent.
+PARTY_KEY_PARTS = ("meta", "scores", "members", "leaders", "shown")
+# A sorted set of the parties, scored by the time at which they end.
+PARTY_DEADLINES = "parties:deadlines"
+
+
+def decode(value):
+    """
+    Returns a string read from redis as text, since redis replies
+    with bytes.
+
+    Args:
+        value:  A value read from redis.
+    """
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def session_key(sender):
+    """
+    Returns the key of a user's session.
+
+    Args:
+        sender: The user's phone number.
+    """
+    return SESSION_PREFIX + sender
+
+
+def party_key(party_name, part):
+    """
+    Returns the key of one of a party's records.
+
+    Args:
+        party_name: A string representing the party's name.
+        part:       One of PARTY_KEY_PARTS.
+    """
+    return u"".join([u"{party:", party_name, u"}:", part])
+
+
+def party_keys(party_name):
+    """
+    Returns the keys of all of a party's records.
+
+    Args:
+        party_name: A string representing the party's name.
+    """
+    return [party_key(party_name, part) for part in PARTY_KEY_PARTS]
+
+
+def parse_party_key(key):
+    """
+    Splits the key of one of a party's records into the party's name and
+    the part of the party's records that the key holds.
+
+    Args:
+        key:    A key.
+
+    Returns:
+        A tuple in the form (party_name, part), or None if the key doesn't
+        hold a party's records.
+    """
+    if not key.startswith(u"{party:"):
+        return None
+    party_name, _, part = key[len(u"{party:"):].rpartition(u"}:")
+    if not party_name or part not in PARTY_KEY_PARTS:
+        return None
+    return party_name, part
+
+
+# Python stand-ins for the Lua scripts that the app runs, keyed by the
+# scripts' source, used by stores that can't run Lua.
+_script_fallbacks = {}
+
+
+def script_fallback(script):
+    """
+    Registers a function as the stand-in for a Lua script, for stores that
+    can't run Lua. The function is called with the store, and the script's
+    keys and arguments, while no other command can run on the store.
+
+    Args:
+        script: The Lua script's source.
+
+    Returns:
+        A decorator, which registers the function it decorates.
+    """
+    def register(function):
+        _script_fallbacks[script] = function
+        return function
+    return register
+
+
+def store_stats(store):
+    """
+    Returns the name of a store's backend, along with any of its counters.
+
+    Args:
+        store:  The store.
+    """
+    if isinstance(store, MemoryStore):
+        stats = store.stats()
+        stats["backend"] = "memory"
+        return stats
+    return {"backend": "redis" if store else None}
+
+
+def _locked(method):
+    """
+    Decorates a method of MemoryStore, so that it runs while no other
+    command can.
+    """
+    @wraps(method)
+    def locked_method(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return locked_method
+
+
+def _encode(value):
+    """
+    Returns a value written to the memory store as text, as redis would.
+    """
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return value if isinstance(value, str) else str(value)
+
+
+class MemoryStore(object):
+    """
+    A thread-safe store that keeps the app's state within this process,
+    with the same interface as the subset of redis that the app uses. It
+    holds at most some number of keys, evicting the least recently used
+    key when full, and honours expiries.
+
+    State isn't shared with other processes, and is lost when the process
+    exits, so it suits a single process that can't reach redis, as well as
+    benchmarks that shouldn't wait on the network.
+    """
+
+    def __init__(self, max_keys):
+        """
+        Args:
+            max_keys:   The largest number of keys to hold.
+        """
+        self._max_keys = max_keys
+        # Maps each key to its type and its value, from the least to the
+        # most recently used key.
+        self._data = OrderedDict()
+        self._expires = {}
+        # Numbers each key in the order in which it was created, so that
+        # a scan's cursor stays put as keys are used, added and deleted.
+        # The numbers are also kept in order, along with the numbers of
+        # keys that have since been removed, until there are enough of
+        # those to be worth dropping.
+        self._created = {}
+        self._creation_order = []
+        self._removed_since_compaction = 0
+        self._last_created = 0
+        self._channels = {}
+        self._lock = RLock()
+        self._counts = {"evictions": 0, "expirations": 0}
+
+    def stats(self):
+        """
+        Returns the number of keys held, along with the eviction and
+        expiration counters.
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats["keys"] = len(self._data)
+            return stats
+
+    # Keys
+
+    @_locked
+    def ping(self):
+        return True
+
+    @_locked
+    def delete(self, *names):
+        return sum(1 for name in names if self._remove(_encode(name)))
+
+    @_locked
+    def exists(self, name):
+        return self._entry(_encode(name)) is not None
+
+    @_locked
+    def expire(self, name, time_):
+        name = _encode(name)
+        if self._entry(name) is None:
+            return False
+        self._expires[name] = time.time() + time_
+        return True
+
+    @_locked
+    def ttl(self, name):
+        # As the legacy redis client does, None is returned when the key
+        # doesn't exist or doesn't expire.
+        name = _encode(name)
+        if self._entry(name) is None or name not in self._expires:
+            return None
+        return int(round(self._expires[name] - time.time()))
+
+    @_locked
+    def rename(self, src, dst):
+        src, dst = _encode(src), _encode(dst)
+        entry = self._entry(src)
+        if entry is None:
+            raise ResponseError("no such key")
+        expires = self._expires.get(src)
+        self._remove(src)
+        self._remove(dst)
+        self._insert(dst, *entry)
+        if expires is not None:
+            self._expires[dst] = expires
+        return True
+
+    @_locked
+    def scan(self, cursor=0, match=None, count=None):
+        # Resume after the key the cursor names, and, as redis does, look at
+        # about count keys, returning fewer if some have been removed.
+        start = bisect.bisect_left(self._creation_order, (int(cursor) + 1,))
+        end = start + (count or 10)
+        keys = []
+        for number, key in self._creation_order[start:end]:
+            if (self._created.get(key) == number and
+                    self._entry(key, touch=False) is not None and
+                    (match is None or fnmatch.fnmatchcase(key, match))):
+                keys.append(key)
+        if end >= len(self._creation_order):
+            return 0, keys
+        return self._creation_order[end - 1][0], keys
+
+    def execute_command(self, *args):
+        if [arg.upper() for arg in args[:2]] == ["MEMORY", "USAGE"]:
+            return self.memory_usage(args[2])
+        raise ResponseError(u"Unsupported command: " + u" ".join(args))
+
+    @_locked
+    def memory_usage(self, name):
+        """
+        Estimates the number of bytes held by a key.
+        """
+        entry = self._entry(_encode(name), touch=False)
+        if entry is None:
+            return None
+        kind, value = entry
+        if kind == "string":
+            items = [value]
+        elif kind == "set":
+            items = list(value)
+        else:
+            items = [item for pair in value.items() for item in pair]
+        return sys.getsizeof(name) + sum(sys.getsizeof(item)
+                                         for item in items)
+
+    # Strings
+
+    @_locked
+    def get(self, name):
+        return self._value(name, "string")
+
+    @_locked
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        name = _encode(name)
+        exists = self._entry(name) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+        self._remove(name)
+        self._insert(name, "string", _encode(value))
+        if ex is not None:
+            self._expires[name] = time.time() + ex
+        elif px is not None:
+            self._expires[name] = time.time() + px / 1000.0
+        return True
+
+    # Hashes
+
+    @_locked
+    def hget(self, name, key):
+        return (self._value(name, "hash") or {}).get(_encode(key))
+
+    @_locked
+    def hgetall(self, name):
+        return dict(self._value(name, "hash") or {})
+
+    @_locked
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, (str, bytes)):
+            keys = [keys]
+        fields = self._value(name, "hash") or {}
+        return [fields.get(_encode(key)) for key in list(keys) + list(args)]
+
+    @_locked
+    def hexists(self, name, key):
+        return _encode(key) in (self._value(name, "hash") or {})
+
+    @_locked
+    def hset(self, name, key, value):
+        fields = self._container(name, "hash", dict)
+        added = _encode(key) not in fields
+        fields[_encode(key)] = _encode(value)
+        return int(added)
+
+    @_locked
+    def hmset(self, name, mapping):
+        fields = self._container(name, "hash", dict)
+        for key, value in mapping.items():
+            fields[_encode(key)] = _encode(value)
+        return True
+
+    @_locked
+    def hincrby(self, name, key, amount=1):
+        fields = self._container(name, "hash", dict)
+        value = int(fields.get(_encode(key), 0)) + int(amount)
+        fields[_encode(key)] = str(value)
+        return value
+
+    @_locked
+    def hdel(self, name, *keys):
+        fields = self._value(name, "hash") or {}
+        deleted = sum(1 for key in keys
+                      if fields.pop(_encode(key), None) is not None)
+        self._remove_if_empty(name)
+        return deleted
+
+    def hscan_iter(self, name, match=None, count=None):
+        with self._lock:
+            items = list((self._value(name, "hash") or {}).items())
+        for key, value in items:
+            if match is None or fnmatch.fnmatchcase(key, match):
+                yield key, value
+
+    # Sets
+
+    @_locked
+    def sadd(self, name, *values):
+        members = self._container(name, "set", set)
+        before = len(members)
+        members.update(_encode(value) for value in values)
+        return len(members) - before
+
+    @_locked
+    def srem(self, name, *values):
+        members = self._value(name, "set") or set()
+        before = len(members)
+        members.difference_update(_encode(value) for value in values)
+        removed = before - len(members)
+        self._remove_if_empty(name)
+        return removed
+
+    @_locked
+    def smembers(self, name):
+        return set(self._value(name, "set") or ())
+
+    @_locked
+    def sismember(self, name, value):
+        return _encode(value) in (self._value(name, "set") or ())
+
+    @_locked
+    def scard(self, name):
+        return len(self._value(name, "set") or ())
+
+    @_locked
+    def srandmember(self, name, number=None):
+        members = sorted(self._value(name, "set") or ())
+        if number is None:
+            return random.choice(members) if members else None
+        if number < 0:
+            return [random.choice(members) for _ in range(-number)
+                    ] if members else []
+        return random.sample(members, min(number, len(members)))
+
+    # Sorted sets
+
+    @_locked
+    def zadd(self, name, *args, **kwargs):
+        # Members come before their scores, as in the legacy redis client.
+        pairs = list(zip(args[::2], args[1::2])) + list(kwargs.items())
+        scores = self._container(name, "zset", dict)
+        added = 0
+        for member, score in pairs:
+            added += _encode(member) not in scores
+            scores[_encode(member)] = float(score)
+        return added
+
+    @_locked
+    def zincrby(self, name, value, amount=1):
+        scores = self._container(name, "zset", dict)
+        score = scores.get(_encode(value), 0.0) + float(amount)
+        scores[_encode(value)] = score
+        return score
+
+    @_locked
+    def zrem(self, name, *values):
+        scores = self._value(name, "zset") or {}
+        removed = sum(1 for value in values
+                      if scores.pop(_encode(value), None) is not None)
+        self._remove_if_empty(name)
+        return removed
+
+    @_locked
+    def zscore(self, name, value):
+        return (self._value(name, "zset") or {}).get(_encode(value))
+
+    @_locked
+    def zcard(self, name):
+        return len(self._value(name, "zset") or {})
+
+    @_locked
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        ordered = self._ordered(name, desc)
+        end = len(ordered) + end if end < 0 else end
+        ordered = ordered[start if start >= 0 else max(0, len(ordered) +
+                                                       start):end + 1]
+        return self._members(ordered, withscores, score_cast_func)
+
+    def zrevrange(self, name, start, end, withscores=False,
+                  score_cast_func=float):
+        return self.zrange(name, start, end, desc=True,
+                           withscores=withscores,
+                           score_cast_func=score_cast_func)
+
+    @_locked
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        ordered = [(member, score) for member, score in self._ordered(name)
+                   if float(min) <= score <= float(max)]
+        if start is not None and num is not None:
+            ordered = ordered[start:start + num]
+        return self._members(ordered, withscores, score_cast_func)
+
+    @_locked
+    def zscan(self, name, cursor=0, match=None, count=None):
+        # The whole sorted set is returned at once, as redis does for
+        # small sorted sets.
+        return 0, [(member, score) for member, score in self._ordered(name)
+                   if match is None or fnmatch.fnmatchcase(member, match)]
+
+    # Publish and subscribe
+
+    @_locked
+    def publish(self, channel, message):
+        queues = self._channels.get(_encode(channel), ())
+        for queue in queues:
+            queue.put({"type": "message", "pattern": None,
+                       "channel": _encode(channel), "data": message})
+        return len(queues)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return MemoryPubSub(self)
+
+    # Locks, pipelines and scripts
+
+    def lock(self, name, timeout=None, sleep=0.1, blocking_timeout=None,
+             **kwargs):
+        return MemoryLock(self, name, timeout, sleep, blocking_timeout)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MemoryPipeline(self)
+
+    def register_script(self, script):
+        if script not in _script_fallbacks:
+            raise ResponseError("The memory store can't run this script")
+        fallback = _script_fallbacks[script]
+
+        def run(keys=(), args=(), client=None):
+            with self._lock:
+                return fallback(self, list(keys), list(args))
+        return run
+
+    # Helpers, called while holding the lock
+
+    def _entry(self, name, touch=True):
+        """
+        Returns a key's type and value, or None if there is no such key.
+        """
+        entry = self._data.get(name)
+        if entry is None:
+            return None
+        if self._expires.get(name, float("inf")) <= time.time():
+            self._remove(name)
+            self._counts["expirations"] += 1
+            return None
+        if touch:
+            self._data.move_to_end(name)
+        return entry
+
+    def _value(self, name, kind):
+        """
+        Returns a key's value, or None if there is no such key.
+        """
+        entry = self._entry(_encode(name))
+        if entry is None:
+            return None
+        if entry[0] != kind:
+            raise ResponseError("WRONGTYPE Operation against a key holding "
+                                "the wrong kind of value")
+        return entry[1]
+
+    def _container(self, name, kind, factory):
+        """
+        Returns a key's value, creating an empty value if there is no
+        such key.
+        """
+        value = self._value(name, kind)
+        if value is None:
+            value = factory()
+            self._insert(_encode(name), kind, value)
+        return value
+
+    def _insert(self, name, kind, value):
+        """
+        Adds a key, evicting the least recently used keys if full.
+        """
+        self._data[name] = (kind, value)
+        self._last_created += 1
+        self._created[name] = self._last_created
+        self._creation_order.append((self._last_created, name))
+        while len(self._data) > self._max_keys:
+            evicted, _ = self._data.popitem(last=False)
+            self._forget(evicted)
+            self._counts["evictions"] += 1
+
+    def _remove(self, name):
+        """
+        Removes a key, returning whether there was such a key.
+        """
+        if self._data.pop(name, None) is None:
+            return False
+        self._forget(name)
+        return True
+
+    def _forget(self, name):
+        """
+        Drops what is kept about a key besides its value.
+        """
+        self._expires.pop(name, None)
+        self._created.pop(name, None)
+        self._removed_since_compaction += 1
+        # Drop the numbers of removed keys once they make up most of the
+        # order, which keeps scans and this compaction cheap on average.
+        if self._removed_since_compaction > len(self._data):
+            self._creation_order = [
+                (number, key) for number, key in self._creation_order
+                if self._created.get(key) == number]
+            self._removed_since_compaction = 0
+
+    def _remove_if_empty(self, name):
+        """
+        Removes a key whose hash, set or sorted set is empty, as redis does.
+        """
+        entry = self._data.get(_encode(name))
+        if entry is not None and not entry[1]:
+            self._remove(_encode(name))
+
+    def _ordered(self, name, desc=False):
+        """
+        Returns a sorted set's members and scores, in order of score.
+        """
+        scores = self._value(name, "zset") or {}
+        return sorted(scores.items(), key=lambda item: (item[1], item[0]),
+                      reverse=desc)
+
+    def _members(self, ordered, withscores, score_cast_func):
+        if withscores:
+            return [(member, score_cast_func(score))
+                    for member, score in ordered]
+        return [member for member, _ in ordered]
+
+    def _subscribe(self, queue, channels):
+        for channel in channels:
+            self._channels.setdefault(_encode(channel), []).append(queue)
+
+    def _unsubscribe(self, queue, channels):
+        for channel in channels:
+            queues = self._channels.get(_encode(channel), [])
+            if queue in queues:
+                queues.remove(queue)
+            if not queues:
+                self._channels.pop(_encode(channel), None)
+
+
+class MemoryPipeline(object):
+    """
+    Queues commands for a MemoryStore, and runs them all at once, while no
+    other command can run.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._store, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self, raise_on_error=True):
+        commands, self._commands = self._commands, []
+        results = []
+        with self._store._lock:
+            for command, args, kwargs in commands:
+                try:
+                    results.append(command(*args, **kwargs))
+                except Exception as error:
+                    if raise_on_error:
+                        raise
+                    results.append(error)
+        return results
+
+
+class MemoryPubSub(object):
+    """
+    Receives the messages published on a MemoryStore's channels.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._queue = Queue()
+        self._channels = []
+
+    def subscribe(self, *channels):
+        with self._store._lock:
+            self._store._subscribe(self._queue, channels)
+        self._channels.extend(channels)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        try:
+            return self._queue.get(timeout=max(timeout, 0) or None,
+                                   block=bool(timeout and timeout > 0))
+        except Empty:
+            return None
+
+    def close(self):
+        with self._store._lock:
+            self._store._unsubscribe(self._queue, self._channels)
+        self._channels = []
+
+
+class MemoryLock(object):
+    """
+    A lock held on a key of a MemoryStore, which expires after some number
+    of seconds.
+    """
+
+    def __init__(self, store, name, timeout=None, sleep=0.1,
+                 blocking_timeout=None):
+        self._store = store
+        self._name = name
+        self._timeout = timeout
+        self._sleep = sleep
+        self._blocking_timeout = blocking_timeout
+        self._token = None
+
+    def acquire(self, blocking=True, blocking_timeout=None):
+        if blocking_timeout is None:
+            blocking_timeout = self._blocking_timeout
+        deadline = None
+        if blocking_timeout is not None:
+            deadline = time.time() + blocking_timeout
+        token = uuid.uuid4().hex
+        while True:
+            if self._store.set(self._name, token, nx=True,
+                               ex=self._timeout):
+                self._token = token
+                return True
+            if not blocking or (deadline is not None and
+                                time.time() >= deadline):
+                return False
+            time.sleep(self._sleep)
+
+    def release(self):
+        with self._store._lock:
+            token, self._token = self._token, None
+            if token is None or self._store.get(self._name) != token:
+                raise LockError("Cannot release a lock that's no longer "
+                                "owned")
+            self._store.delete(self._name)
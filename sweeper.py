@@ -0,0 +1,79 @@
+import logging
+import time
+
+from threading import Event, Thread
+
+from parties import MAX_FINALIZE_ATTEMPTS, close_party, delete_party
+from parties import get_expired_parties
+
+
+class PartySweeper(object):
+    """
+    Periodically ends the parties that are past their deadlines, whether
+    or not their quorums were reached.
+
+    Any number of processes can sweep at once, since only the process that
+    manages to close a party goes on to finalize it. A party that fails to
+    be finalized keeps its deadline, and is retried on a later sweep.
+    """
+
+    def __init__(self, redis, finalize, interval):
+        """
+        Args:
+            redis:      The redis instance.
+            finalize:   A function that announces the winner of a party that
+                        has been closed, called with the party's name and
+                        the redis instance.
+            interval:   The number of seconds between sweeps.
+        """
+        self._redis = redis
+        self._finalize = finalize
+        self._interval = interval
+        self._stopped = Event()
+        self._sweeper = Thread(target=self._work)
+        self._sweeper.daemon = True
+        self._sweeper.start()
+
+    def stop(self):
+        """
+        Stops sweeping.
+        """
+        self._stopped.set()
+        self._sweeper.join()
+
+    def sweep(self):
+        """
+        Closes and finalizes every party that is past its deadline.
+
+        Returns:
+            The number of parties finalized.
+        """
+        finalized = 0
+        for party_name in get_expired_parties(self._redis, time.time()):
+            try:
+                attempt = close_party(self._redis, party_name)
+                if not attempt:
+                    continue
+                if attempt > MAX_FINALIZE_ATTEMPTS:
+                    logging.error(u"Giving up on the {0} Party after {1} "
+                                  u"attempts".format(party_name, attempt - 1))
+                    delete_party(self._redis, party_name)
+                    continue
+                logging.info(u"The {0} Party is past its deadline".format(
+                             party_name))
+                self._finalize(party_name, self._redis)
+                finalized += 1
+            except Exception as error:
+                logging.error(u"Could not finalize the {0} Party: {1}".format(
+                              party_name, error))
+        return finalized
+
+    def _work(self):
+        """
+        Sweeps every interval until told to stop.
+        """
+        while not self._stopped.wait(self._interval):
+            try:
+                self.sweep()
+            except Exception as error:
+                logging.error("Could not sweep parties: " + str(error))
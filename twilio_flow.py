@@ -1,20 +1,31 @@
-import json
 import logging
 import random
+import time
 import yaml
 
 from flask import Blueprint, current_app, request
 
+from cuisine_selection import PARTY_SELECTION, SOLO_SELECTION, is_adaptive
+from cuisine_selection import pick_cuisine
+from idempotency import handles_once
 from image_finder import add_cuisine_images_to_redis
 from location_search import find_similar_locations
+from parties import PARTY_CLOSED, PARTY_OVER, close_party, count_party_cuisine
+from parties import create_party, delete_party, get_party_leaders
+from parties import get_party_results
+from parties import join_party, party_exists, record_party_vote
 from party_names import generate_party_name
 
-from send_logic import client, from_, invalid_option_start_over
-from send_logic import send_first_cuisine, send_one_cuisine_image
-from send_logic import send_similar_locations, send_winner
+from send_logic import from_, invalid_option_start_over, replies_as_twiml
+from send_logic import send_first_cuisine, send_message, send_one_cuisine_image
+from send_logic import send_party_winner, send_similar_locations, send_winner
 from send_logic import send_unsupported_country
 
-from winner_logic import pick_solo_winner, pick_party_winner
+from sessions import SCORE_PREFIX, SHOWN_PREFIX, delete_session, load_session
+from sessions import start_session, update_session
+
+from winner_logic import is_decided, pick_solo_winner, pick_party_winner
+from winner_logic import solo_scores
 from yelp_search import find_cuisines, is_supported_place, find_eatery
 
 
@@ -27,17 +38,25 @@ except Exception as error:
 
 else:
     # TODO:
-    # Allow the party creator to set a quorum size,
-    # as well as a set a limit on the number of votes
-    # that a single indvidual can make
+    # Allow the party creator to set a limit on the number
+    # of votes that a single indvidual can make
     SOLO_QUORUM = config["quorum"]["solo"]
     PARTY_QUORUM = config["quorum"]["party"]
+    # The default and longest durations of a party, in minutes,
+    # along with the largest quorum that a party's creator can choose.
+    PARTY_DURATION = config["parties"]["duration"]
+    MAX_PARTY_DURATION = config["parties"]["max_duration"]
+    MAX_PARTY_QUORUM = config["parties"]["max_quorum"]
+    # Whether to stop voting once the winner can no longer change.
+    EARLY_STOP = config["quorum"]["early_stop"]
 
 
 receive_text_blueprint = Blueprint("process_text", __name__)
 
 
 @receive_text_blueprint.route("/sms", methods=["POST"])
+@handles_once
+@replies_as_twiml
 def process_text():
     # Keep a reference to the message sent by a user
     message = request.form["Body"]
@@ -48,40 +67,39 @@ def process_text():
 
     # Allow user to quit from a session
     if message.lower() == "d":
-        redis.hdel("users", sender)
+        delete_session(redis, sender)
         return "", 200
 
     # Start off a session to either create a party, or to go solo
     if message.lower().startswith("food"):
         # Initialize a session for the user.
-        # Each user's number is used as a key in redis.
-        # The associated value contains the user's history.
-        # This history is stored in JSON.
+        # Each user's number is used to key a redis hash.
+        # The hash's fields contain the user's history.
         # (We want to create a session for the user).
         # Next time a user sends a message, we want to be aware of the user's
         # "previous" interaction with the app.
-        init_history = json.dumps({"previous": "food"})
-        # TODO: set the user to expire after certain time period
-        redis.hset("users", sender, init_history)
+        # The session expires if the user stops sending messages.
+        start_session(redis, sender, {"previous": "food"})
         location_message = "".join(["Whereabouts would you like to eat?"])
-        client.messages.create(to=sender, from_=from_, body=location_message)
+        send_message(sender, from_, location_message)
         return "", 200
 
     # Check if we have a record of this user.
-    sender_history = redis.hget("users", sender)
+    sender_history = load_session(redis, sender)
     # If not, check whether the user is trying to join a party.
-    if not sender_history and redis.sismember("parties", message):
+    if not sender_history and party_exists(redis, message):
         # The user is joining a party.
         party_name = message
-        response = u"You have joined the {0} Party!".format(party_name)
-        client.messages.create(to=sender, from_=from_, body=response)
-
-        # Add this user to the party's roster
-        redis.sadd(u"members:" + party_name, sender)
 
-        # Determine which cuisines have been allotted to this party.
-        cuisines = redis.hget("parties:cuisines", party_name)
-        cuisines = json.loads(cuisines)
+        # Add this user to the party's roster, and determine which cuisines
+        # have been allotted to this party.
+        cuisines = join_party(redis, party_name, sender)
+        if cuisines is None:
+            response = u"Sorry! The {0} Party has ended.".format(party_name)
+            send_message(sender, from_, response)
+            return "", 200
+        response = u"You have joined the {0} Party!".format(party_name)
+        send_message(sender, from_, response)
 
         # Select the user's first cuisine.
         first_cuisine = random.choice(cuisines)
@@ -92,25 +110,19 @@ def process_text():
 
         # Send the user the first cuisine.
         send_first_cuisine(sender_history, sender, from_, redis)
-        sender_history = json.dumps(sender_history)
-        # TODO: The user's entry should expire after a certain period of time
-        redis.hset("users", sender, sender_history)
         return "", 200
 
     # Welcome a user to begin a new session, or to join a party.
     if sender_history is None:
         response = "".join(["Welcome to Tender! Please send 'food' to begin! ",
                             "Or send the name of a party you want to join."])
-        client.messages.create(to=sender, from_=from_, body=response)
+        send_message(sender, from_, response)
         return "", 200
 
-    # Parse the user's history as a python dictionary
-    sender_history = json.loads(sender_history)
-
     # The user has just begun a session and has sent a location.
     if sender_history["previous"] == "food":
         # Determine whether the provided location is unique
-        sim_locations = find_similar_locations(message)
+        sim_locations = find_similar_locations(message, redis)
         # If the location is ambiguous, ask the user to clarify
         if len(sim_locations) > 1:
             send_similar_locations(sender_history, sim_locations,
@@ -120,7 +132,7 @@ def process_text():
         elif len(sim_locations) == 1:
             location = sim_locations[0]
             place_id, address = location
-            if not is_supported_place(place_id):
+            if not is_supported_place(place_id, redis):
                 send_unsupported_country(sender, from_, redis)
                 return "", 200
             sender_history["location"] = address
@@ -129,8 +141,8 @@ def process_text():
         # It looks as if the user has provided a strange location...
         else:
             response = "Something's wrong... please start over."
-            client.messages.create(to=sender, from_=from_, body=response)
-            redis.hdel("users", sender)
+            send_message(sender, from_, response)
+            delete_session(redis, sender)
             return "", 200
 
     # Parse the user's response to disambiguate ambiguous locations
@@ -144,7 +156,7 @@ def process_text():
         # Use the user's answer to pick a location
         location = locations[int(message) - 1]
         place_id, address = location
-        if not is_supported_place(place_id):
+        if not is_supported_place(place_id, redis):
             send_unsupported_country(sender, from_, redis)
             return "", 200
         sender_history["location"] = address
@@ -156,10 +168,12 @@ def process_text():
     # (The latter allows the user to create a party).
     if sender_history["previous"] == "uniqueLocation":
         response = "Are we eating (s)olo or (y)olo?"
-        client.messages.create(to=sender, from_=from_, body=response)
+        send_message(sender, from_, response)
         sender_history["previous"] = "syolo"
-        sender_history = json.dumps(sender_history)
-        redis.hset("users", sender, sender_history)
+        update_session(redis, sender,
+                       fields={"location": sender_history["location"],
+                               "previous": "syolo"},
+                       deleted=["ambiguousLocations"])
         return "", 200
 
     # The user has answered whether or not to eat alone
@@ -202,71 +216,55 @@ def process_text():
             # to provide a custom name instead.
             response = ''.join(['Send a "y" if you want to call this the "',
                                 party_name, '" Party',
-                                "... or text back your own choice of name!"])
-            client.messages.create(to=sender, from_=from_, body=response)
+                                "... or text back your own choice of name! ",
+                                'Add "q=" and a number of votes, or "t=" ',
+                                "and a number of minutes, to choose when ",
+                                "the party ends."])
+            send_message(sender, from_, response)
 
             # Keep a record of our suggested party name.
             sender_history["partyName"] = party_name
             sender_history["previous"] = "partyName"
-            sender_history = json.dumps(sender_history)
-            redis.hset("users", sender, sender_history)
+            update_session(redis, sender, fields={
+                "cuisines": sender_history["cuisines"],
+                "previousCuisine": first_cuisine,
+                "partyName": party_name,
+                "previous": "partyName"})
         return "", 200
 
     # Parse the user's response to our party name suggestion
     if sender_history["previous"] == "partyName":
+        # Set aside the quorum and duration that the user may have chosen
+        message, quorum, duration = parse_party_options(
+            message, sender_history.get("partyQuorum", PARTY_QUORUM),
+            sender_history.get("partyDuration", PARTY_DURATION))
+
         # It seems that the user would like to create a custom party name
-        if message.lower() not in {'y', '"y"', "'y'", 'yes', '"yes"', "'yes'"}:
-            # However, if this name is not currently available...
-            if redis.sismember("parties", message):
-                # Suggest another party name, or ask the user for another one
-                party_name = generate_party_name()
-                response = u"Sorry! There is already a party with that name. "
-                response += ''.join(['Send a "y" if you want to be the "',
-                                     party_name, '" Party instead',
-                                     "... or send your own choice of name!"])
-                client.messages.create(to=sender, from_=from_, body=response)
-                sender_history["partyName"] = party_name
-                sender_history = json.dumps(sender_history)
-                redis.hset("users", sender, sender_history)
-                return "", 200
-            # If the name is available, we'll use it
+        if message and message.lower() not in {'y', '"y"', "'y'", 'yes',
+                                               '"yes"', "'yes'"}:
             sender_history["partyName"] = message
 
         # We have settled on a party name
         party_name = sender_history["partyName"]
-        # Add this party to a set of active parties
-        redis.sadd("parties", party_name)
 
         # Let's create session information for this party.
         # The session will contain the allotted cuisines and the location.
-        cuisines = sender_history["cuisines"]
-        location = sender_history["location"]
-        redis.hset("parties:locations", party_name, location)
-        redis.hset("parties:cuisines", party_name, json.dumps(cuisines))
-        redis.hset("parties:quorums", party_name, PARTY_QUORUM)
-
-        # Can't store party scores in a redis hash, since the values
-        # will have to be serialized in JSON. This will in turn cause
-        # issues with concurrency when keeping track of votes from
-        # different users.
-
-        # This pollutes the redis key space. An alternate approach
-        # could be to keep individual scores for each user and then
-        # add the scores up once voting is complete. However, some
-        # users will finish voting before others. Users that finish
-        # voting should be free to join other sessions, rather than
-        # be blocked. Keeping this in mind, using individual scores
-        # leads to the same concurrency issues with using a redis hash.
-        for cuisine in cuisines:
-            # Use a redis sorted set to keep track of the scores of
-            # the cuisines allotted to a party. Each cuisine starts
-            # off with a score of zero.
-            redis.zadd(u"scores:" + party_name, cuisine, 0)
-        # Similarly, in the case that we have multiple members joining
-        # a party at the same time, we need to be able to atomically
-        # modify the members in any given party.
-        redis.sadd(u"members:" + party_name, sender)
-        redis.expire(u"members:" + party_name, 3600)
+        # However, if this name is not currently available...
+        if not create_party(redis, party_name, sender_history["location"],
+                            sender_history["cuisines"], quorum,
+                            time.time() + duration * 60, sender):
+            # Suggest another party name, or ask the user for another one
+            party_name = generate_party_name()
+            response = u"Sorry! There is already a party with that name. "
+            response += ''.join(['Send a "y" if you want to be the "',
+                                 party_name, '" Party instead',
+                                 "... or send your own choice of name!"])
+            send_message(sender, from_, response)
+            update_session(redis, sender,
+                           fields={"partyName": party_name,
+                                   "partyQuorum": quorum,
+                                   "partyDuration": duration})
+            return "", 200
 
         # Send the user the first image.
         send_first_cuisine(sender_history, sender, from_, redis)
@@ -274,50 +272,15 @@ def process_text():
 
     # The user has responded to the previously sent image
     if sender_history["previous"] == "sentCuisine":
-        # Determine whether we have reached a quorum for this session
-        if sender_history.get("partyName", False):
-            # TODO: time based quorum (compare waiting for a quorum of votes)
-            party_name = sender_history["partyName"]
-            total_images_sent = redis.zscore("parties:images_sent", party_name)
-            quorum = int(redis.hget("parties:quorums", party_name))
-        else:
-            total_images_sent = sender_history["imagesSent"]
-            quorum = SOLO_QUORUM
-
-        # If the total number of images sent is enough to meet a quorum,
-        # pick a winner, and notify those that are involved.
-        if total_images_sent >= quorum:
-            if sender_history.get("partyName", False):
-                # Get the scores for the cuisines in this party
-                scores = redis.zrange(u"scores:" + party_name, 0, -1,
-                                      withscores=True)
-                winner = pick_party_winner(party_name, scores, redis)
-                location = redis.hget(u"parties:locations", party_name)
-                eatery = find_eatery(winner, location)
-                party_members = redis.smembers(u"members:" + party_name)
-                for party_member in party_members:
-                    # Notify the party member of the winning cuisine, note,
-                    # this simultaneously deletes the party member's history.
-                    send_winner(winner, eatery, party_member, from_,
-                                redis, party=party_name)
-                # Delete records of the party, now that the party has ended
-                redis.delete(u"members:" + party_name)
-                redis.delete(u"scores:" + party_name)
-                redis.hdel("parties:quorums", party_name)
-                redis.hdel("parties:locations", party_name)
-                redis.hdel("parties:cuisines", party_name)
-                redis.zrem("parties:images_sent", party_name)
-                redis.srem("parties", party_name)
-            else:
-                scores = sender_history["scores"]
-                winner = pick_solo_winner(scores)
-                location = sender_history["location"]
-                eatery = find_eatery(winner, location)
-                send_winner(winner, eatery, sender, from_, redis)
+        party_name = sender_history.get("partyName", False)
+
+        # If the total number of images sent to this sole user is enough
+        # to meet a quorum, pick a winner, and notify the user.
+        if not party_name and sender_history["imagesSent"] >= SOLO_QUORUM:
+            finalize_solo(sender, sender_history, redis)
             return "", 200
 
         # Since a quorum has not been reached yet, modify this cuisine's score
-        # TODO: There may be a race condition leading to unfair polling here!
         if message.lower().startswith("r"):
             score = 1
         elif message.lower().startswith("l"):
@@ -327,31 +290,157 @@ def process_text():
             # The score for the cuisine is not affected, but let
             # the user know that the response was invalid.
             response = "That's not how you fork..."
-            client.messages.create(to=sender, from_=from_, body=response)
+            send_message(sender, from_, response)
             score = 0
         cuisine = sender_history["previousCuisine"]
 
+        # Count the image that's about to be sent to this user
+        increments = {"imagesSent": 1}
+
         # Increment this cuisine's score in this user's party
-        if sender_history.get("partyName", False):
-            party_name = sender_history["partyName"]
-            redis.zincrby(u"scores:" + party_name, cuisine, score)
-            redis.zincrby("parties:images_sent", party_name)
-            cuisines = redis.hget("parties:cuisines", party_name)
-            cuisines = json.loads(cuisines)
+        if party_name:
+            outcome, party = record_party_vote(redis, party_name,
+                                               cuisine, score)
+            # If this vote has brought the party to its quorum,
+            # pick a winner, and notify those that are involved.
+            if outcome == PARTY_CLOSED:
+                finalize_party(party_name, redis)
+                return "", 200
+            # Someone else's vote has already ended the party.
+            if outcome == PARTY_OVER:
+                delete_session(redis, sender)
+                return "", 200
+            # Stop early if the remaining votes can't change the winner.
+            # Besides the votes counted until the quorum is reached,
+            # the vote that reaches the quorum is counted too.
+            if EARLY_STOP:
+                remaining = party["quorum"] - party["images_sent"] + 1
+                if (is_decided(party["scores"], remaining)
+                        and close_party(redis, party_name)):
+                    finalize_party(party_name, redis)
+                    return "", 200
 
         # Increment this cuisine's score for this sole user
         else:
-            if cuisine not in sender_history["scores"]:
-                sender_history["scores"][cuisine] = 0
-            sender_history["scores"][cuisine] += score
+            increments[SCORE_PREFIX + cuisine] = score
             cuisines = sender_history["cuisines"]
-
+            scores = sender_history.setdefault("scores", {})
+            scores[cuisine] = scores.get(cuisine, 0) + score
+            # Stop early if the remaining votes can't change the winner.
+            # Cuisines that haven't been voted on yet have a score of zero.
+            if EARLY_STOP:
+                remaining = SOLO_QUORUM - sender_history["imagesSent"] - 1
+                all_scores = solo_scores(cuisines, scores)
+                if is_decided(list(all_scores.items()), remaining):
+                    finalize_solo(sender, sender_history, redis)
+                    return "", 200
+
+        # Pick the next cuisine to be sent to this user
+        if party_name:
+            cuisine = pick_party_cuisine(redis, party_name, party)
+        else:
+            shown = sender_history.setdefault("shown", {})
+            cuisine = pick_cuisine(SOLO_SELECTION, cuisines, scores, shown)
+            increments[SHOWN_PREFIX + cuisine] = 1
         # Send the next cuisine to be sent to this user
-        cuisine = random.choice(cuisines)
         send_one_cuisine_image(sender, from_, cuisine, redis)
-        sender_history["imagesSent"] += 1
-        sender_history["previousCuisine"] = cuisine
-        sender_history = json.dumps(sender_history)
-        redis.hset("users", sender, sender_history)
+        update_session(redis, sender, fields={"previousCuisine": cuisine},
+                       increments=increments)
         return "", 200
     return party_name
+
+
+def parse_party_options(message, quorum, duration):
+    """
+    Separates the options that a party's creator can add to the reply to
+    our party name suggestion from the rest of the reply. "q=<number>" sets
+    the party's quorum, and "t=<minutes>" sets how long the party lasts.
+
+    Args:
+        message:    The user's reply.
+        quorum:     The quorum used unless the user has chosen one.
+        duration:   The duration used unless the user has chosen one.
+
+    Returns:
+        A tuple in the form (message, quorum, duration), where message is
+        the reply without the options.
+    """
+    words = []
+    for word in message.split():
+        option, _, value = word.partition("=")
+        if option.lower() == "q" and value.isdigit():
+            quorum = min(max(int(value), 1), MAX_PARTY_QUORUM)
+        elif option.lower() == "t" and value.isdigit():
+            duration = min(max(int(value), 1), MAX_PARTY_DURATION)
+        else:
+            words.append(word)
+    # Leave the party name as it was sent, unless there were any options.
+    if len(words) < len(message.split()):
+        message = " ".join(words)
+    return message, quorum, duration
+
+
+def pick_party_cuisine(redis, party_name, party):
+    """
+    Picks the next cuisine to send to one of a party's members.
+
+    Args:
+        redis:      The redis instance.
+        party_name: A string representing the party's name.
+        party:      A dictionary of the party's cuisines and tallies, as
+                    returned by record_party_vote.
+
+    Returns:
+        A string representing the next cuisine.
+    """
+    cuisines = party["cuisines"]
+    if not is_adaptive(PARTY_SELECTION):
+        return pick_cuisine(PARTY_SELECTION, cuisines, {}, {})
+    cuisine = pick_cuisine(PARTY_SELECTION, cuisines, dict(party["scores"]),
+                           party["shown"])
+    count_party_cuisine(redis, party_name, cuisine)
+    return cuisine
+
+
+def finalize_solo(sender, sender_history, redis):
+    """
+    Picks the winning cuisine of a solo user, notifies the user, and then
+    deletes the user's session.
+
+    Args:
+        sender:         The user's phone number.
+        sender_history: A dictionary containing the user's session history.
+        redis:          The redis instance.
+    """
+    scores = sender_history["scores"]
+    if EARLY_STOP:
+        # The winner is picked from the same scores that the early stop
+        # weighs, so a cuisine that hasn't been sent yet beats the disliked
+        # cuisines.
+        scores = solo_scores(sender_history["cuisines"], scores)
+    winner = pick_solo_winner(scores)
+    location = sender_history["location"]
+    eatery = find_eatery(winner, location, redis)
+    send_winner(winner, eatery, sender, from_, redis)
+
+
+def finalize_party(party_name, redis):
+    """
+    Picks the winning cuisine of a party that has ended, notifies the party's
+    members, and then deletes the records of the party.
+
+    Args:
+        party_name: A string representing the party's name.
+        redis:      The redis instance.
+    """
+    location, party_members = get_party_results(redis, party_name)
+    # The winner is picked from the cuisines leading the party's vote
+    leaders, _ = get_party_leaders(redis, party_name)
+    winner = pick_party_winner(leaders)
+    eatery = find_eatery(winner, location, redis)
+    # Notify the party's members of the winning cuisine, note,
+    # this simultaneously deletes the party members' histories.
+    send_party_winner(winner, eatery, party_members, from_, redis,
+                      party=party_name)
+    # Delete records of the party, now that the party has ended
+    delete_party(redis, party_name)
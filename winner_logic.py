@@ -1,5 +1,7 @@
 import random
 
+from storage import decode
+
 
 def pick_solo_winner(scores):
     """
@@ -20,28 +22,82 @@ def pick_solo_winner(scores):
         inverted_scores[score].add(cuisine)
     max_score = max(inverted_scores)
     winners = inverted_scores[max_score]
-    winner = random.sample(winners, 1)[0]
+    winner = random.choice(sorted(winners))
     return winner
 
 
-def pick_party_winner(party_name, scores, redis):
+def solo_scores(cuisines, scores):
+    """
+    Gathers a solo user's scores for every cuisine, so that the early stop
+    and the pick of the winner weigh the same cuisines.
+
+    Args:
+        cuisines:   A list of strings of the cuisines allotted to the user.
+        scores:     A dictionary mapping the cuisines that the user has
+                    voted on to their scores.
+
+    Returns:
+        A dictionary mapping every cuisine to its score, where cuisines
+        that haven't been voted on yet have a score of zero.
+    """
+    all_scores = dict.fromkeys(cuisines, 0)
+    all_scores.update(scores)
+    return all_scores
+
+
+def pick_party_winner(leaders):
     """
     Picks the winning cuisine, given the user was part of a party.
 
     Args:
-        party_name: A string representing the user's party name.
+        leaders:    A list of the cuisines tied for the highest score.
+
+    Returns:
+        A string representing the winning cuisine.
+    """
+    winner = random.choice(sorted(leaders))
+    return winner
+
+
+def find_leaders(scores):
+    """
+    Finds the cuisines tied for the highest score.
+
+    Args:
         scores: 	A list of tuples, with each tuple in the form
                     (cuisine, score), representing the total score
-                    for some cuisine. The list is sorted in ascending
-                    order of score.
+                    for some cuisine.
 
     Returns:
-        A string representing the winning cuisine.
+        A tuple in the form (leaders, max_score), where leaders is a list
+        of the cuisines holding the highest score, max_score.
     """
+    if not scores:
+        return [], None
     # Find the score held by the highest scoring cuisine(s)
-    max_score = scores[-1][-1]
-    # Pull the cuisines that have the highest score
-    winners = redis.zrangebyscore(u"scores:" + party_name,
-                                  max_score, max_score)
-    winner = random.sample(winners, 1)[0]
-    return winner
+    max_score = max(score for _, score in scores)
+    leaders = [decode(cuisine) for cuisine, score in scores
+               if score == max_score]
+    return leaders, max_score
+
+
+def is_decided(scores, remaining_votes):
+    """
+    Determines whether the leading cuisine can no longer be caught. Each
+    vote changes a single cuisine's score by at most one, so the lead can
+    shrink by at most one with each vote that's left.
+
+    Args:
+        scores:             A list of tuples, with each tuple in the form
+                            (cuisine, score), representing the total score
+                            for some cuisine.
+        remaining_votes:    The largest number of votes that can still be
+                            counted.
+
+    Returns:
+        A boolean, indicating whether the winner is already decided.
+    """
+    ordered = sorted((score for _, score in scores), reverse=True)
+    if len(ordered) < 2:
+        return True
+    return ordered[0] - ordered[1] > remaining_votes
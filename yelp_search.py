@@ -1,32 +1,41 @@
 
-from image_finder import add_cuisine_images_to_redis
+from image_finder import add_cuisine_images_to_redis, has_cuisine_images
 
+import json
 import logging
 import os
 import random
 import requests
+import time
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from threading import Lock
+
+from caching import TTLCache
 from location_search import find_country_code
+from storage import decode
 
 
-def is_supported_place(place_id):
+def is_supported_place(place_id, redis=None):
     """
     Determines whether place_id is within a country supported by Yelp,
     uses SUPPORTED_LOCALES to check for Yelp support.
 
     Args:
         place_id: A string representing Google's identifier for some place.
+        redis:    Reference to the redis server.
 
     Returns:
         A boolean, indicating whether place_id is within a country
         supported by Yelp.
     """
-    country_code = find_country_code(place_id)
+    country_code = find_country_code(place_id, redis)
     return country_code in SUPPORTED_LOCALES
 
 
-def find_cuisines(location, redis=None):
+def find_cuisines(location, redis):
     """
     Finds types of cuisines near the provided location,
     uses RADIUS to determine the search radius.
@@ -39,29 +48,7 @@ def find_cuisines(location, redis=None):
         A list of strings representing cuisines found
         near the provided location.
     """
-    # We want distinct cuisines, so we use a set.
-    cuisines = set([])
-    # This is the request to get the first page of results
-    # from Yelp's API.
-    base_request = "".join([YELP_ENDPOINT,
-                            "?radius=", str(RADIUS),
-                            "&categories=restaurants",
-                            "&location=", location])
-    # Send an offset in the query to pull more results
-    # from Yelp's API.
-    offset = 0
-    businesses = True
-    while businesses and offset < YELP_RESULTS_LIMIT:
-        api_request = "{0}&offset={1}".format(base_request, offset)
-        response = requests.get(api_request,
-                                headers=YELP_HEADER).json()
-        businesses = response["businesses"]
-        for business in businesses:
-            for category in business["categories"]:
-                cuisine = category["title"]
-                if cuisine not in CUISINE_BLACKLIST:
-                    cuisines.add(category["title"])
-        offset += 20
+    cuisines = _find_cached_nearby_cuisines(location, redis)
     # Using a list speeds up sampling, also, sets aren't JSON serializable.
     cuisines = list(cuisines)
 
@@ -75,25 +62,207 @@ def find_cuisines(location, redis=None):
     else:
         cuisines = random.sample(cuisines, CUISINE_SAMPLE_SIZE)
 
-    if redis:
-        # Find and then add to redis images of the sampled cuisines.
-        add_cuisine_images_to_redis(cuisines, redis)
-
-        # Potential savings: we can check redis to see if we already have
-        # images for one of the sampled cuisines. If we do, we'll move that
-        # cuisine to the start of our list, and then send images for this
-        # "first cuisine" right at the start.
-        idx = 0
-        found_cuisine_in_redis = False
-        while not found_cuisine_in_redis and idx < len(cuisines):
-            cuisine = cuisines[idx]
-            if redis.hexists("cuisines", cuisine):
-                cuisines[idx], cuisines[0] = cuisines[0], cuisines[idx]
-                found_cuisine_in_redis = True
-            idx += 1
+    # Find and then add to redis images of the sampled cuisines.
+    add_cuisine_images_to_redis(cuisines, redis)
+
+    # Potential savings: we can check redis to see if we already have
+    # images for one of the sampled cuisines. If we do, we'll move that
+    # cuisine to the start of our list, and then send images for this
+    # "first cuisine" right at the start.
+    idx = 0
+    found_cuisine_in_redis = False
+    while not found_cuisine_in_redis and idx < len(cuisines):
+        cuisine = cuisines[idx]
+        if has_cuisine_images(cuisine, redis):
+            cuisines[idx], cuisines[0] = cuisines[0], cuisines[idx]
+            found_cuisine_in_redis = True
+        idx += 1
     return cuisines
 
 
+def _search_nearby_eateries(location):
+    """
+    Searches Yelp for eateries near the provided location and groups them
+    by the type of cuisine that they serve, uses RADIUS to determine the
+    search radius.
+
+    Args:
+        location:   A string representing a location.
+
+    Returns:
+        A dictionary mapping strings representing cuisines found near
+        the provided location to lists of eateries serving them.
+    """
+    # Each cuisine maps to the eateries that serve it, so that the eatery
+    # suggested for the winning cuisine doesn't need another search.
+    eateries = {}
+    # This is the request to get the first page of results
+    # from Yelp's API.
+    base_request = "".join([YELP_ENDPOINT,
+                            "?radius=", str(RADIUS),
+                            "&categories=restaurants",
+                            "&location=", location])
+    # Pull the pages of results from Yelp's API at the same time, by
+    # sending a different offset in each query.
+    pages = [_page_executor.submit(_fetch_businesses, base_request, offset)
+             for offset in range(0, YELP_RESULTS_LIMIT, 20)]
+    for page in as_completed(pages):
+        try:
+            businesses = page.result()
+        except Exception as error:
+            logging.error("Could not fetch a page from Yelp: " + str(error))
+            continue
+        for business in businesses:
+            eatery = _trim_eatery(business)
+            for category in business["categories"]:
+                cuisine = category["title"]
+                if cuisine not in CUISINE_BLACKLIST:
+                    eateries.setdefault(cuisine, []).append(eatery)
+    return eateries
+
+
+def _trim_eatery(business):
+    """
+    Keeps only what we need to suggest an eatery, so that eateries look the
+    same however they were found.
+
+    Args:
+        business:   A dictionary representing a business from Yelp's API.
+
+    Returns:
+        A dictionary mapping each of EATERY_FIELDS to the business's value
+        for it, or None if the business doesn't have one.
+    """
+    return dict((field, business.get(field)) for field in EATERY_FIELDS)
+
+
+def _nearby_key(location):
+    """
+    Returns the redis key under which the cuisines near the location are
+    cached. Locations are normalized, so that the same address written
+    slightly differently shares an entry.
+
+    Args:
+        location: A string representing a location.
+    """
+    return u"nearby:{0}:{1}".format(RADIUS, _normalize_location(location))
+
+
+def _normalize_location(location):
+    """
+    Returns the location in lower case, without commas or extra spaces.
+
+    Args:
+        location: A string representing a location.
+    """
+    return " ".join(location.lower().replace(",", " ").split())
+
+
+def _find_cached_nearby_cuisines(location, redis):
+    """
+    Finds types of cuisines near the provided location, using the cuisines
+    cached for the location when there are any. A stale entry is still
+    used, but is refreshed in the background. Otherwise, the whole area is
+    searched once and cached, since every page of the search is requested
+    at the same time anyway.
+
+    Args:
+        location: A string representing a location.
+        redis:    Reference to the redis server.
+
+    Returns:
+        A list of strings representing cuisines found
+        near the provided location.
+    """
+    fetched_at, cuisines = redis.hmget(_nearby_key(location),
+                                       "fetched_at", "cuisines")
+    if cuisines is None:
+        eateries = _search_nearby_eateries(location)
+        _cache_nearby_eateries(location, eateries, redis)
+        return list(eateries)
+    if time.time() - float(fetched_at) > NEARBY_FRESH_TTL:
+        _queue_nearby_refresh(location, redis)
+    return json.loads(cuisines)
+
+
+def _queue_nearby_refresh(location, redis):
+    """
+    Queues a refresh of the cuisines cached for the location, unless the
+    location is already being refreshed.
+
+    Args:
+        location: A string representing a location.
+        redis:    Reference to the redis server.
+    """
+    lock = u"nearby:refreshing:" + _nearby_key(location)
+    if redis.set(lock, "1", nx=True, ex=NEARBY_REFRESH_TIMEOUT):
+        _refresh_executor.submit(_refresh_nearby_cuisines,
+                                 location, redis, lock)
+
+
+def _refresh_nearby_cuisines(location, redis, lock):
+    """
+    Searches Yelp for every type of cuisine near the location and caches
+    the cuisines found, along with the eateries serving each cuisine.
+
+    Args:
+        location: A string representing a location.
+        redis:    Reference to the redis server.
+        lock:     The key held while the location is being refreshed.
+    """
+    try:
+        eateries = _search_nearby_eateries(location)
+        _cache_nearby_eateries(location, eateries, redis)
+    except Exception as error:
+        logging.error(u"Could not refresh cuisines near {0}: {1}".format(
+                      location, error))
+    finally:
+        redis.delete(lock)
+
+
+def _cache_nearby_eateries(location, eateries, redis):
+    """
+    Caches the cuisines found near the location, along with the eateries
+    serving each cuisine, for NEARBY_FRESH_TTL plus NEARBY_STALE_TTL seconds.
+
+    Args:
+        location: A string representing a location.
+        eateries: A dictionary mapping the cuisines found near the location
+                  to lists of eateries serving them.
+        redis:    Reference to the redis server.
+    """
+    # An empty search is more likely a failure than an empty area.
+    if not eateries:
+        return
+    key = _nearby_key(location)
+    entry = {"fetched_at": time.time(),
+             "cuisines": json.dumps(list(eateries))}
+    for cuisine, cuisine_eateries in eateries.items():
+        entry[u"eateries:" + cuisine] = json.dumps(cuisine_eateries)
+    pipeline = redis.pipeline()
+    # Drop the eateries of cuisines that are no longer nearby.
+    pipeline.delete(key)
+    pipeline.hmset(key, entry)
+    pipeline.expire(key, NEARBY_FRESH_TTL + NEARBY_STALE_TTL)
+    pipeline.execute()
+
+
+def _fetch_businesses(base_request, offset):
+    """
+    Fetches a page of businesses from Yelp's API.
+
+    Args:
+        base_request: A string representing the request for the first page.
+        offset:       The offset of the page's first business.
+
+    Returns:
+        A list of dictionaries, each representing a business.
+    """
+    api_request = "{0}&offset={1}".format(base_request, offset)
+    response = YELP_SESSION.get(api_request).json()
+    return response["businesses"]
+
+
 def get_updated_cat_map(yelp_cat_map):
     """
     Converts Yelp's category codes for cuisines to
@@ -106,7 +275,7 @@ def get_updated_cat_map(yelp_cat_map):
         A mapping of Yelp's category codes to their semantic meanings
         (For example, as of writing, "diyfood" maps to "Do-It-Yourself Food").
     """
-    raw_mapping = requests.get(yelp_cat_map, headers=YELP_HEADER).json()["categories"]
+    raw_mapping = YELP_SESSION.get(yelp_cat_map).json()["categories"]
     updated_mapping = {}
     for category in raw_mapping:
         alias = category["alias"]
@@ -115,7 +284,168 @@ def get_updated_cat_map(yelp_cat_map):
     return updated_mapping
 
 
-def find_eatery(cuisine, location):
+def get_cat_map(redis):
+    """
+    Returns the mapping of Yelp's categories, loading it the first time
+    that it's needed. The mapping is shared by every process through redis,
+    and is reloaded from there at most once every CAT_MAP_RELOAD_INTERVAL
+    seconds.
+
+    Args:
+        redis:  Reference to the redis server.
+
+    Returns:
+        A mapping of the titles of Yelp's categories to their codes.
+    """
+    with _cat_map_lock:
+        if time.time() - _cat_map["loaded_at"] < CAT_MAP_RELOAD_INTERVAL:
+            return _cat_map["categories"]
+    meta = _load_cat_map(redis)
+    if meta is None:
+        # Nobody has fetched the categories yet, so we have to wait.
+        _first_load_cat_map(redis)
+    elif time.time() - meta["fetched_at"] > CAT_MAP_REFRESH_INTERVAL:
+        _queue_cat_map_refresh(redis)
+    return _cat_map["categories"]
+
+
+def _load_cat_map(redis):
+    """
+    Loads the mapping of Yelp's categories from redis, unless this process
+    already holds the latest version.
+
+    Args:
+        redis:  Reference to the redis server.
+
+    Returns:
+        A dictionary with the version of the mapping and the time at which
+        it was fetched from Yelp, or None if it has never been fetched.
+    """
+    meta = _parse_cat_map_meta(redis.hgetall(CAT_MAP_KEY + ":meta"))
+    if meta is None:
+        return None
+    categories = None
+    if meta["version"] != _cat_map["version"]:
+        # The mapping and its version are read together, so that the
+        # mapping is never kept under another version.
+        pipeline = redis.pipeline()
+        pipeline.hgetall(CAT_MAP_KEY + ":meta")
+        pipeline.hgetall(CAT_MAP_KEY)
+        meta, categories = pipeline.execute()
+        meta = _parse_cat_map_meta(meta)
+        categories = dict((decode(title), decode(alias))
+                          for title, alias in categories.items())
+    _set_cat_map(categories, meta)
+    return meta
+
+
+def _parse_cat_map_meta(meta):
+    """
+    Parses the version of the mapping of Yelp's categories, and the time at
+    which it was fetched, as read from redis.
+
+    Args:
+        meta:   The fields of the mapping's ":meta" hash.
+
+    Returns:
+        A dictionary with the version of the mapping and the time at which
+        it was fetched from Yelp, or None if it has never been fetched.
+    """
+    if not meta:
+        return None
+    return dict((decode(field), float(value)) for field, value in meta.items())
+
+
+def _set_cat_map(categories, meta):
+    """
+    Updates this process's copy of the mapping of Yelp's categories.
+
+    Args:
+        categories: A mapping of the titles of Yelp's categories to their
+                    codes, or None if the copy is still the latest version.
+        meta:       A dictionary with the version of the mapping and the
+                    time at which it was fetched from Yelp.
+    """
+    with _cat_map_lock:
+        if categories is not None:
+            _cat_map["categories"] = categories
+            _cat_map["version"] = meta["version"]
+        _cat_map["loaded_at"] = time.time()
+
+
+def _first_load_cat_map(redis):
+    """
+    Fetches the mapping of Yelp's categories for the first time, unless
+    another process is already fetching it, in which case the mapping that
+    the other process fetches is waited for.
+
+    Args:
+        redis:  Reference to the redis server.
+    """
+    lock = CAT_MAP_KEY + ":refreshing"
+    if redis.set(lock, "1", nx=True, ex=CAT_MAP_REFRESH_INTERVAL):
+        if _refresh_cat_map(redis) is None:
+            # Let the next caller try again.
+            redis.delete(lock)
+        return
+    deadline = time.time() + CAT_MAP_LOAD_WAIT
+    while time.time() < deadline:
+        time.sleep(0.1)
+        if _load_cat_map(redis) is not None:
+            return
+    # Whoever was fetching the mapping seems to have given up.
+    _refresh_cat_map(redis)
+
+
+def _queue_cat_map_refresh(redis):
+    """
+    Queues a refresh of the mapping of Yelp's categories, unless the mapping
+    has already been refreshed within the last CAT_MAP_REFRESH_INTERVAL
+    seconds by any process.
+
+    Args:
+        redis:  Reference to the redis server.
+    """
+    if not redis.set(CAT_MAP_KEY + ":refreshing", "1",
+                     nx=True, ex=CAT_MAP_REFRESH_INTERVAL):
+        return
+    _refresh_executor.submit(_refresh_cat_map, redis)
+
+
+def _refresh_cat_map(redis):
+    """
+    Fetches the mapping of Yelp's categories from Yelp, and shares it through
+    redis.
+
+    Args:
+        redis:  Reference to the redis server.
+
+    Returns:
+        A dictionary with the version of the mapping and the time at which
+        it was fetched from Yelp.
+    """
+    try:
+        categories = get_updated_cat_map(YELP_CAT_JSON)
+    except Exception as error:
+        logging.error("Could not fetch Yelp's categories: " + str(error))
+        # Keep using the categories that we have for now.
+        _set_cat_map(None, None)
+        return None
+    meta = {"version": (_cat_map["version"] or 0) + 1,
+            "fetched_at": time.time()}
+    # The version is bumped in the same transaction that replaces the
+    # mapping, so that no one sees one without the other.
+    pipeline = redis.pipeline()
+    pipeline.delete(CAT_MAP_KEY)
+    pipeline.hmset(CAT_MAP_KEY, categories)
+    pipeline.hset(CAT_MAP_KEY + ":meta", "fetched_at", meta["fetched_at"])
+    pipeline.hincrby(CAT_MAP_KEY + ":meta", "version")
+    meta["version"] = pipeline.execute()[-1]
+    _set_cat_map(categories, meta)
+    return meta
+
+
+def find_eatery(cuisine, location, redis):
     """
     Finds an eatery that serves a certain cuisine near the provided location,
     uses RADIUS to determine search radius.
@@ -123,42 +453,62 @@ def find_eatery(cuisine, location):
     Args:
         cuisine:  A string representing some cuisine type.
         location: A string representing some location.
+        redis:    Reference to the redis server.
 
     Returns:
-        A string representing some eatery.
+        A dictionary representing some eatery, with the EATERY_FIELDS of
+        a business from Yelp's API.
     """
+    # The eateries found while looking for cuisines near the location
+    # usually include some that serve this cuisine.
+    eateries = redis.hget(_nearby_key(location), u"eateries:" + cuisine)
+    if eateries:
+        return _trim_eatery(random.choice(json.loads(eateries)))
+
     # Search for the cuisine by first determining Yelp's category coding
     # for the cuisine.
     # Check first whether the given cuisine has an encoding in Yelp's
     # categories.json file.
     # (It should have an entry, since the names of the cuisine types
     # are specific to Yelp's own API).
-    if cuisine not in YELP_CAT_MAP:
-        # Try updating our current mapping of the categories.
-        updated_mapping = get_updated_cat_map(YELP_CAT_JSON)
-        YELP_CAT_MAP.update(updated_mapping)
-        # If updating the mapping didn't help, something's wrong somewhere.
+    cat_map = get_cat_map(redis)
+    if cuisine not in cat_map:
+        # Our mapping of the categories may be out of date, so have it
+        # refreshed in the background, rather than holding up this search.
+        _queue_cat_map_refresh(redis)
         # Log it as an error, and set the category to pizza for now
         # ... because why not?
-        if cuisine not in YELP_CAT_MAP:
-            logging.error("Something going on with Yelp's categories.json")
-            # When the world is on fire, Pizza will still be there.
-            category = "pizza"
-        else:
-            category = YELP_CAT_MAP[cuisine]
+        logging.error(u"No category in Yelp's categories.json for " + cuisine)
+        # When the world is on fire, Pizza will still be there.
+        category = "pizza"
     else:
-        category = YELP_CAT_MAP[cuisine]
-    request = "".join([YELP_ENDPOINT,
-                       "?radius=", str(RADIUS),
-                       "&categories=", category,
-                       "&location=", location])
-    response = requests.get(request,
-                            headers=YELP_HEADER).json()
-    businesses = response["businesses"]
-    eatery = random.choice(businesses)
+        category = cat_map[cuisine]
+    # Winning cuisines are often looked up again for the same location.
+    cache_key = (category, _normalize_location(location))
+    businesses = _eatery_cache.get(cache_key)
+    if businesses is None:
+        request = "".join([YELP_ENDPOINT,
+                           "?radius=", str(RADIUS),
+                           "&categories=", category,
+                           "&location=", location])
+        response = YELP_SESSION.get(request).json()
+        businesses = [_trim_eatery(business)
+                      for business in response["businesses"]]
+        if businesses:
+            _eatery_cache.set(cache_key, businesses)
+    # Keep callers from modifying the cached eateries.
+    eatery = dict(random.choice(businesses))
     return eatery
 
 
+def eatery_cache_stats():
+    """
+    Returns the size and the hit, miss and eviction counters of this
+    process's cache of eateries.
+    """
+    return _eatery_cache.stats()
+
+
 try:
     with open("config", "r") as stream:
         config = yaml.safe_load(stream)
@@ -171,6 +521,32 @@ else:
     YELP_HEADER = {"Authorization": "Bearer " + YELP_KEY}
     YELP_ENDPOINT = config["endpoints"]["yelp"]
 
+    # Requests to Yelp's API share pooled keep-alive connections.
+    YELP_SESSION = requests.Session()
+    YELP_SESSION.headers.update(YELP_HEADER)
+    YELP_SESSION.mount("https://", HTTPAdapter(
+        pool_maxsize=config["limits"]["yelp_connections"]))
+    # Pages of Yelp's results are fetched by their own threads.
+    _page_executor = ThreadPoolExecutor(
+        max_workers=config["limits"]["yelp_connections"])
+
+    # The fields of Yelp's businesses kept when caching eateries.
+    EATERY_FIELDS = ["id", "name", "image_url", "url", "rating", "price",
+                     "location"]
+
+    # Eateries found for a category near a location are cached.
+    _eatery_cache = TTLCache(max_size=config["yelp"]["eatery_cache_size"],
+                             ttl=config["yelp"]["eatery_cache_ttl"])
+
+    # Cuisines near a location are cached, and considered fresh for
+    # NEARBY_FRESH_TTL seconds. After that, they are still used for up to
+    # NEARBY_STALE_TTL seconds, while being refreshed in the background.
+    NEARBY_FRESH_TTL = config["yelp"]["nearby_fresh_ttl"]
+    NEARBY_STALE_TTL = config["yelp"]["nearby_stale_ttl"]
+    # Seconds after which an unfinished refresh may be tried again.
+    NEARBY_REFRESH_TIMEOUT = 60
+    _refresh_executor = ThreadPoolExecutor(max_workers=2)
+
     # Maintain a list of some cuisines that make it difficult to find
     # good, relevant images.
     CUISINE_BLACKLIST = set(config["yelp"]["cuisine_blacklist"])
@@ -189,4 +565,18 @@ else:
 
     # The URL to the JSON file containing Yelp's categories mapping.
     YELP_CAT_JSON = config["yelp"]["cat_json"]
-    YELP_CAT_MAP = get_updated_cat_map(YELP_CAT_JSON)  # Store this on redis?
+    # The mapping is kept in redis under this key, with its version and the
+    # time at which it was fetched kept under the key suffixed with ":meta".
+    # The braces keep both keys in the same slot, so that they can be
+    # written together in a transaction.
+    CAT_MAP_KEY = "{yelp:categories}"
+    # Seconds after which the mapping is fetched again from Yelp.
+    CAT_MAP_REFRESH_INTERVAL = config["yelp"]["cat_refresh_interval"]
+    # Seconds after which a process checks for a newer version of the mapping.
+    CAT_MAP_RELOAD_INTERVAL = config["yelp"]["cat_reload_interval"]
+    # This process's copy of the mapping, loaded when first needed.
+    _cat_map = {"categories": {}, "version": None, "loaded_at": 0}
+    _cat_map_lock = Lock()
+    # Seconds to wait for another process to fetch the mapping for the
+    # first time, before fetching it ourselves.
+    CAT_MAP_LOAD_WAIT = 10